@@ -1,9 +1,66 @@
 import pandas as pd
-import os, subprocess, concurrent.futures, time, logging
+import os, sys, subprocess, concurrent.futures, time, logging, re, hashlib, collections, functools, shutil, tempfile
+import json, resource, signal
+import array_finder, fasta_io
+from resource_limiter import MemoryBudget, kill_children_on_exit, parse_size, run_with_usage
 
 
-def locate_array_kmers(num_of_repeats, rep_min, rep_max, spa_min, spa_max, input_file, sequence_out, logger):
+def counted(records, metrics):
+    # scaffolds are counted in the pass that reads them anyway
+    for record in records:
+        metrics['scaffolds'] += 1
+        yield record
+
+
+def candidate_records(input_file, num_of_repeats, rep_min, rep_max, spa_min, spa_max, metrics):
+    # scaffolds that pass the k-mer prefilter, i.e. carry periodic exact repeats at CRISPR spacing
+    with fasta_io.open_fasta(input_file) as handle:
+        for name, sequence in counted(array_finder.read_fasta(handle), metrics):
+            if array_finder.prefilter(sequence, num_of_repeats, rep_min, rep_max, spa_min, spa_max):
+                yield name, sequence
+
+
+def new_metrics(input_file):
+    # one row of array_scan_metrics.jsonl; cpu_s, peak_rss and returncode are those of the minced child (native:
+    # the worker, returncode stays None)
+    return {'fna_path': input_file, 'input_bytes': os.path.getsize(input_file), 'scaffolds': None, 'wall_s': 0.0,
+            'cpu_s': 0.0, 'peak_rss': 0, 'arrays': 0, 'returncode': None}
+
+
+def child_usage(metrics, usage):
+    metrics['cpu_s'] = usage.ru_utime + usage.ru_stime
+    metrics['peak_rss'] = usage.ru_maxrss * 1024
+
+
+def count_arrays(gff_path):
+    with open(gff_path) as gff:
+        return sum(1 for line in gff if not line.startswith('#'))
+
+
+def locate_array_kmers(num_of_repeats, rep_min, rep_max, spa_min, spa_max, input_file, sequence_out, logger,
+                       timeout=None, prefilter=False):
+    fifo = writer = candidates_fna = None
+    metrics = new_metrics(input_file)
+    started = time.time()
     try:
+        minced_input = input_file
+        if prefilter:
+            metrics['scaffolds'] = 0
+            candidates = list(candidate_records(input_file, num_of_repeats, rep_min, rep_max, spa_min, spa_max,
+                                                metrics))
+            if not candidates:
+                return input_file, None, 'done', metrics  # no candidate repeats, minced is skipped
+            candidates_fna = f'{sequence_out}.candidates.fna'
+            with open(candidates_fna, 'w') as out:
+                out.writelines(f'>{name}\n{sequence}\n' for name, sequence in candidates)
+            minced_input = candidates_fna
+        elif fasta_io.compression(input_file):
+            # minced only reads plain fasta: stream the decompressed genome through a named pipe
+            fifo = f'{sequence_out}.fifo'
+            writer = fasta_io.feed_fifo(input_file, fifo)
+            minced_input = fifo
+        else:
+            metrics['scaffolds'] = fasta_io.count_records(input_file)
         minced_run = [
             'minced',
             '-minNR', str(num_of_repeats),
@@ -12,18 +69,410 @@ def locate_array_kmers(num_of_repeats, rep_min, rep_max, spa_min, spa_max, input
             '-minSL', str(spa_min),
             '-maxSL', str(spa_max),
             '-gff',
-            input_file,
+            minced_input,
             sequence_out
         ]
-        subprocess.run(minced_run)
+        returncode, usage = run_with_usage(minced_run, timeout=timeout)  # the hung JVM is killed on timeout
+        child_usage(metrics, usage)
+        metrics['returncode'] = returncode
+        if returncode != 0:
+            raise RuntimeError(f'minced exited with code {returncode}')
+        if writer is not None:
+            writer.join(timeout=10)  # minced read the pipe to its end
+            metrics['scaffolds'] = writer.records
         if os.path.getsize(sequence_out) > 0:
-            return input_file, sequence_out
+            metrics['arrays'] = count_arrays(sequence_out)
+            return input_file, sequence_out, 'done', metrics
         else:
             os.remove(sequence_out)
-            return input_file, None
+            return input_file, None, 'done', metrics
+    except subprocess.TimeoutExpired as e:
+        child_usage(metrics, e.usage)
+        metrics['returncode'] = -signal.SIGKILL
+        logger.warning(f"minced timed out after {timeout} seconds on {input_file}")
+        if os.path.exists(sequence_out):
+            os.remove(sequence_out)
+        return input_file, None, 'timeout', metrics
+    except Exception as e:
+        logger.exception(f"An error occurred while processing the {input_file}: {e}")
+        return input_file, None, 'error', metrics  # Return None for sequence_out if an error occurs
+    finally:
+        metrics['wall_s'] = time.time() - started
+        if fifo is not None:
+            fasta_io.release_fifo(fifo, writer)
+        if candidates_fna is not None and os.path.exists(candidates_fna):
+            os.remove(candidates_fna)
+
+
+def locate_array_native(num_of_repeats, rep_min, rep_max, spa_min, spa_max, input_file, sequence_out, logger,
+                        timeout=None, prefilter=False):
+    # in-process alternative to minced: no JVM start-up, one pass over the fasta (timeout is not enforced here)
+    metrics = dict(new_metrics(input_file), scaffolds=0)
+    started, usage = time.time(), resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        with fasta_io.open_fasta(input_file) as handle:
+            records = counted(array_finder.read_fasta(handle), metrics)
+            if prefilter:
+                records = (record for record in records if array_finder.prefilter(record[1], num_of_repeats, rep_min,
+                                                                                   rep_max, spa_min, spa_max))
+            lines = list(array_finder.gff_lines(records, num_of_repeats, rep_min, rep_max, spa_min, spa_max))
+        metrics['arrays'] = len(lines)
+        if lines:
+            with open(sequence_out, 'w') as out:
+                out.write('##gff-version 3\n')
+                out.writelines(lines)
+            return input_file, sequence_out, 'done', metrics
+        return input_file, None, 'done', metrics
     except Exception as e:
         logger.exception(f"An error occurred while processing the {input_file}: {e}")
-        return input_file, None  # Return None for sequence_out if an error occurs
+        return input_file, None, 'error', metrics
+    finally:
+        finished = resource.getrusage(resource.RUSAGE_SELF)
+        metrics['wall_s'] = time.time() - started
+        metrics['cpu_s'] = finished.ru_utime + finished.ru_stime - usage.ru_utime - usage.ru_stime
+        metrics['peak_rss'] = finished.ru_maxrss * 1024  # lifetime peak of the worker process
+
+
+BATCH_SEP = '__'  # per-genome record prefix in a batched fasta: >{genome index}__{original header}
+
+
+def batch_by_size(file_list, batch_bytes, file_sizes):
+    # group consecutive genomes until the batch reaches batch_bytes; big genomes end up alone
+    batches, batch, size = [], [], 0
+    for fna in file_list:
+        batch.append(fna)
+        size += file_sizes[fna]
+        if size >= batch_bytes:
+            batches.append(batch)
+            batch, size = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def locate_array_batch(num_of_repeats, rep_min, rep_max, spa_min, spa_max, input_files, outdir, logger,
+                       timeout=None, prefilter=False):
+    # one minced (one JVM) for many small genomes, the combined GFF is split back to one file per genome
+    if len(input_files) == 1:
+        fna = input_files[0]
+        return [locate_array_kmers(num_of_repeats, rep_min, rep_max, spa_min, spa_max, fna,
+                                   f'{outdir}/repeat_info/{fna.split("/")[-1]}_minced_out.txt', logger, timeout,
+                                   prefilter)]
+    batch_dir = f'{outdir}/tmp_batches'
+    os.makedirs(batch_dir, exist_ok=True)
+    batch_name = f'{batch_dir}/{os.getpid()}_{id(input_files)}_{input_files[0].split("/")[-1]}'
+    # wall time, CPU time and peak RSS are those of the whole minced run, shared by every genome of the batch
+    all_metrics = [dict(new_metrics(fna), scaffolds=0, batch_size=len(input_files)) for fna in input_files]
+    try:
+        n_records = 0
+        with open(f'{batch_name}.fna', 'w') as out:
+            for n, fna in enumerate(input_files):
+                if prefilter:
+                    for name, sequence in candidate_records(fna, num_of_repeats, rep_min, rep_max, spa_min, spa_max,
+                                                            all_metrics[n]):
+                        out.write(f'>{n}{BATCH_SEP}{name}\n{sequence}\n')
+                        n_records += 1
+                    continue
+                n_records += 1
+                with fasta_io.open_fasta(fna) as handle:
+                    line = ''
+                    for line in handle:
+                        if line.startswith('>'):
+                            line = f'>{n}{BATCH_SEP}{line[1:].lstrip()}'
+                            all_metrics[n]['scaffolds'] += 1
+                        out.write(line)
+                    if not line.endswith('\n'):
+                        out.write('\n')
+        if n_records == 0:
+            return [(fna, None, 'done', metrics) for fna, metrics in zip(input_files, all_metrics)]  # all prefiltered
+        _, _, status, batch_metrics = locate_array_kmers(num_of_repeats, rep_min, rep_max, spa_min, spa_max,
+                                                         f'{batch_name}.fna', f'{batch_name}.gff', logger, timeout)
+        for metrics in all_metrics:
+            metrics.update(wall_s=batch_metrics['wall_s'], cpu_s=batch_metrics['cpu_s'],
+                           peak_rss=batch_metrics['peak_rss'], returncode=batch_metrics['returncode'])
+        if status != 'done':
+            return [(fna, None, status, metrics) for fna, metrics in zip(input_files, all_metrics)]
+
+        gff_by_genome = [[] for _ in input_files]
+        if os.path.exists(f'{batch_name}.gff'):
+            with open(f'{batch_name}.gff') as gff:
+                for line in gff:
+                    if line.startswith('#') or BATCH_SEP not in line:
+                        continue
+                    n, record = line.split(BATCH_SEP, 1)
+                    gff_by_genome[int(n)].append(record)
+        file_pairs = []
+        for fna, records, metrics in zip(input_files, gff_by_genome, all_metrics):
+            metrics['arrays'] = len(records)
+            if not records:
+                file_pairs.append((fna, None, 'done', metrics))
+                continue
+            sequence_out = f'{outdir}/repeat_info/{fna.split("/")[-1]}_minced_out.txt'
+            with open(sequence_out, 'w') as out:
+                out.write('##gff-version 3\n')
+                # CRISPR ids are numbered per input file by minced, keep them per genome
+                for i, record in enumerate(records, start=1):
+                    out.write(re.sub(r'ID=CRISPR\d+;', f'ID=CRISPR{i};', record, count=1))
+            file_pairs.append((fna, sequence_out, 'done', metrics))
+        return file_pairs
+    except Exception as e:
+        logger.exception(f"An error occurred while processing the batch starting with {input_files[0]}: {e}")
+        return [(fna, None, 'error', metrics) for fna, metrics in zip(input_files, all_metrics)]
+    finally:
+        for suffix in ('.fna', '.gff'):
+            if os.path.exists(f'{batch_name}{suffix}'):
+                os.remove(f'{batch_name}{suffix}')
+
+
+def prefilter_scaffolds(input_file, num_of_repeats, rep_min, rep_max, spa_min, spa_max):
+    # [(scaffold, length, passed the prefilter)] for the recall benchmark
+    with fasta_io.open_fasta(input_file) as handle:
+        return [(name, len(sequence), array_finder.prefilter(sequence, num_of_repeats, rep_min, rep_max, spa_min,
+                                                             spa_max))
+                for name, sequence in array_finder.read_fasta(handle)]
+
+
+def read_gff_records(file_path, fna):
+    # minced GFF records of one genome, from its *_minced_out.txt or from the parquet array store
+    if os.path.isdir(file_path):
+        import array_store  # optional (pyarrow), only needed for --store parquet
+        df_gff = array_store.read_arrays(file_path, fna)
+        return ['\t'.join(map(str, row)) + '\n' for row in df_gff.itertuples(index=False)]
+    with open(file_path) as gff:
+        return [line for line in gff if not line.startswith('#')]
+
+
+def prefilter_benchmark(file_list, labelled_tsv, params, num_threads, outdir):
+    # labels = scaffolds with an array in a full (unfiltered) run over the same genomes, i.e. its minced_out2fna.tsv
+    df_label = pd.read_csv(labelled_tsv, sep='\t')
+    positives = set()
+    for fna, gff in zip(df_label['fna_path'], df_label['file_path']):
+        positives.update((fna, record.split('\t', 1)[0]) for record in read_gff_records(gff, fna))
+
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_threads) as executor:
+        scans = executor.map(functools.partial(prefilter_scaffolds, **params), file_list, chunksize=16)
+        for fna, scaffolds in zip(file_list, scans):
+            rows.extend((fna, name, length, passed, (fna, name) in positives) for name, length, passed in scaffolds)
+    df_bench = pd.DataFrame(rows, columns=['fna_path', 'scaffold', 'length', 'passed', 'has_array'])
+    df_bench.to_csv(f'{outdir}/prefilter_benchmark.tsv', sep='\t', index=False)
+
+    df_genome = df_bench.groupby('fna_path')[['passed', 'has_array']].any()
+    scaffold_recall = df_bench.loc[df_bench['has_array'], 'passed'].mean()
+    genome_recall = df_genome.loc[df_genome['has_array'], 'passed'].mean()
+    bp_kept = df_bench.loc[df_bench['passed'], 'length'].sum() / max(1, df_bench['length'].sum())
+    print(f'prefilter recall: {scaffold_recall:.4f} of {int(df_bench["has_array"].sum())} array scaffolds, '
+          f'{genome_recall:.4f} of {int(df_genome["has_array"].sum())} array genomes')
+    print(f'prefilter passes {df_bench["passed"].mean():.4f} of scaffolds, {df_genome["passed"].mean():.4f} of '
+          f'genomes and {bp_kept:.4f} of bp to the array caller')
+
+
+def scaffold_digests(input_file):
+    # [(scaffold, length, digest)], identical scaffold sequences share a digest; None if the genome cannot be read
+    try:
+        with fasta_io.open_fasta(input_file) as handle:
+            return [(name, len(sequence), hashlib.blake2b(sequence.encode(), digest_size=16).hexdigest())
+                    for name, sequence in array_finder.read_fasta(handle)]
+    except OSError:
+        return None
+
+
+def write_unique_scaffolds(input_file, owned, unique_fna):
+    # the scaffolds this genome is the first to contribute, renamed to their digest
+    with fasta_io.open_fasta(input_file) as handle, open(unique_fna, 'w') as out:
+        for name, sequence in array_finder.read_fasta(handle):
+            if name in owned:
+                out.write(f'>{owned[name]}\n{sequence}\n')
+    return unique_fna
+
+
+def dedup_scaffolds(genome_list, outdir, num_threads):
+    # hash every scaffold once; only scaffolds never seen before are written to unique_scaffolds/*.unique.fna,
+    # which are then scanned in place of the genomes. scaffold_digests.tsv maps every genome scaffold to its digest
+    # and to the unique fasta that carries it (also read by 02_ap_pairs_v2.py --dedup)
+    digest_path = f'{outdir}/scaffold_digests.tsv'
+    unique_dir = f'{outdir}/unique_scaffolds'
+    os.makedirs(unique_dir, exist_ok=True)
+    hashed, digest_owner = set(), {}
+    new_digest_file = not os.path.exists(digest_path)
+    if not new_digest_file:
+        hashed = set(pd.read_csv(digest_path, sep='\t', dtype=str, usecols=['fna_path'])['fna_path'])
+    to_hash = [fna for fna in dict.fromkeys(genome_list) if fna not in hashed]
+    if to_hash and not new_digest_file:  # the digest owners only when there is something to hash
+        df_known = pd.read_csv(digest_path, sep='\t', dtype=str, usecols=['digest', 'unique_fna'])
+        digest_owner = dict(zip(df_known['digest'], df_known['unique_fna']))
+
+    unique_tasks, digest_rows = [], []
+    n_scaffolds = n_unique = n_unreadable = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_threads) as executor:
+        for fna, scaffolds in zip(to_hash, executor.map(scaffold_digests, to_hash, chunksize=8)):
+            if scaffolds is None:
+                n_unreadable += 1  # not recorded as hashed, tried again on the next run
+                continue
+            path_hash = hashlib.sha1(fna.encode()).hexdigest()[:8]
+            unique_fna = f'{unique_dir}/{fna.split("/")[-1]}.{path_hash}.unique.fna'
+            owned = {}
+            for name, length, digest in scaffolds:
+                if digest not in digest_owner:
+                    digest_owner[digest] = unique_fna
+                    owned[name] = digest
+                digest_rows.append(f'{fna}\t{name}\t{length}\t{digest}\t{digest_owner[digest]}\n')
+            n_scaffolds += len(scaffolds)
+            n_unique += len(owned)
+            if owned:
+                unique_tasks.append((fna, owned, unique_fna))
+        if unique_tasks:
+            list(executor.map(write_unique_scaffolds, *zip(*unique_tasks)))
+    # the rows only after every unique fasta they point to is written: a crash in between leaves these genomes
+    # unrecorded, so the next run hashes them (and writes their unique fasta) again
+    with open(digest_path, 'a') as digest_file:
+        if new_digest_file:
+            digest_file.write('fna_path\tscaffold\tlength\tdigest\tunique_fna\n')
+        digest_file.writelines(digest_rows)
+    print(f'dedup: {n_scaffolds} scaffolds in {len(to_hash) - n_unreadable} new genomes, {n_unique} not seen before')
+    if n_unreadable:
+        print(f'dedup: {n_unreadable} genomes could not be read and are skipped')
+    return [f'{unique_dir}/{name}' for name in sorted(os.listdir(unique_dir)) if name.endswith('.unique.fna')]
+
+
+def read_digests(digest_path, keep):
+    # the scaffold_digests.tsv rows keep(chunk) selects, read in chunks
+    chunks = [chunk[keep(chunk)] for chunk in pd.read_csv(digest_path, sep='\t', dtype=str, chunksize=1000000)]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def fan_out_arrays(genome_list, outdir, manifest, scanned, store=None):
+    # arrays called on unique scaffolds are copied back to every genome carrying that scaffold. Only genomes not
+    # fanned out before, or carrying a unique scaffold scanned in this run, are written; dedup_fan_out.tsv lists every
+    # fanned out genome (empty file_path: no arrays) and, as the manifest does without --dedup, gives the
+    # minced_out2fna.tsv rows of earlier runs
+    fan_out_path = f'{outdir}/dedup_fan_out.tsv'
+    digest_path = f'{outdir}/scaffold_digests.tsv'
+    fanned = {}
+    if os.path.exists(fan_out_path):
+        df_fanned = pd.read_csv(fan_out_path, sep='\t', dtype=str, keep_default_na=False)
+        fanned = dict(zip(df_fanned['fna_path'], df_fanned['file_path']))  # the last entry of a genome wins
+    genomes = set(genome_list)
+    targets = genomes - set(fanned)
+    if scanned:
+        targets |= set(read_digests(digest_path, lambda chunk: chunk['unique_fna'].isin(scanned) &
+                                    chunk['fna_path'].isin(genomes))['fna_path'])
+    if not targets:
+        return [(fna, fanned[fna]) for fna in dict.fromkeys(genome_list) if fanned.get(fna)]
+
+    df_digest = read_digests(digest_path, lambda chunk: chunk['fna_path'].isin(targets))
+    arrays = collections.defaultdict(list)
+    for unique_fna in set(df_digest['unique_fna']):
+        entry = manifest.get(unique_fna)
+        if entry is not None and entry.status == 'done' and entry.file_path:
+            for line in read_gff_records(entry.file_path, unique_fna):
+                digest, record = line.split('\t', 1)
+                arrays[digest].append(record)
+
+    new_fanned, incomplete = [], 0
+    for fna, df_genome in df_digest.groupby('fna_path', sort=False):
+        if not all(unique_fna in manifest and manifest[unique_fna].status == 'done'
+                   for unique_fna in set(df_genome['unique_fna'])):
+            incomplete += 1  # some of its scaffolds are not scanned yet, left for the next run
+            continue
+        records = [f'{scaffold}\t{record}' for scaffold, digest in zip(df_genome['scaffold'], df_genome['digest'])
+                   for record in arrays.get(digest, [])]
+        if store is not None:
+            store.add_gff(fna, records)  # also without records: a genome's earlier arrays are no longer read
+            new_fanned.append((fna, store.store_dir if records else ''))
+            continue
+        if not records:
+            new_fanned.append((fna, ''))
+            continue
+        sequence_out = f'{outdir}/repeat_info/{fna.split("/")[-1]}_minced_out.txt'
+        with open(sequence_out, 'w') as out:
+            out.write('##gff-version 3\n')
+            for i, record in enumerate(records, start=1):
+                out.write(re.sub(r'ID=CRISPR\d+;', f'ID=CRISPR{i};', record, count=1))
+        new_fanned.append((fna, sequence_out))
+    if store is not None:
+        store.flush()
+    # recorded once the arrays are written: a genome lost to a crash in between is fanned out again next run
+    new_fan_out = not os.path.exists(fan_out_path)
+    with open(fan_out_path, 'a') as fan_out:
+        if new_fan_out:
+            fan_out.write('fna_path\tfile_path\n')
+        fan_out.writelines(f'{fna}\t{file_path}\n' for fna, file_path in new_fanned)
+    fanned.update(new_fanned)
+    print(f'dedup: {len(new_fanned)} genomes fanned out')
+    if incomplete:
+        print(f'dedup: {incomplete} genomes wait for unique scaffolds that failed or timed out')
+    return [(fna, fanned[fna]) for fna in dict.fromkeys(genome_list) if fanned.get(fna)]
+
+
+MANIFEST_COLUMNS = ['fna_path', 'size', 'mtime', 'digest', 'file_path', 'status']
+
+
+def file_key(fna, resume_key):
+    # identity of an input genome for the progress manifest: size + mtime, or a content hash; size and mtime are
+    # None for a genome that cannot be read (missing, no permission)
+    try:
+        stat = os.stat(fna)
+        digest = ''
+        if resume_key == 'hash':
+            sha1 = hashlib.sha1()
+            with open(fna, 'rb') as handle:
+                for block in iter(lambda: handle.read(1 << 20), b''):
+                    sha1.update(block)
+            digest = sha1.hexdigest()
+    except OSError:
+        return fna, None, None, ''
+    return fna, stat.st_size, int(stat.st_mtime), digest
+
+
+def load_manifest(manifest_path):
+    # last entry per genome wins; a half-written last line from a crash is ignored
+    if not os.path.exists(manifest_path):
+        return {}
+    df_manifest = pd.read_csv(manifest_path, sep='\t', dtype={'digest': str, 'file_path': str},
+                              keep_default_na=False, on_bad_lines='skip')
+    df_manifest = df_manifest[df_manifest['status'].isin(['done', 'error', 'timeout'])]
+    return {row.fna_path: row for row in df_manifest.drop_duplicates('fna_path', keep='last').itertuples()}
+
+
+def is_done(entry, key, resume_key):
+    if entry is None or entry.status != 'done':
+        return False
+    if resume_key == 'hash':
+        return entry.digest == key[3]
+    return int(entry.size) == key[1] and int(entry.mtime) == key[2]
+
+
+def task_timeout(task_bytes, attempt, timeout_base, timeout_per_mb):
+    # scaled with the input size, doubled on every retry
+    return (timeout_base + timeout_per_mb * task_bytes / 1e6) * 2 ** attempt
+
+
+def progress_line(n_done, n_total, bytes_done, bytes_total, elapsed, in_flight):
+    # live throughput, ETA from the bytes still to scan, and the longest-running tasks in flight
+    rate = bytes_done / 1e6 / max(elapsed, 1e-6)
+    eta = f'{(bytes_total - bytes_done) / 1e6 / rate / 60:.1f} min' if rate > 0 else 'unknown'
+    now = time.time()
+    running = sorted(((now - submitted, task) for task, _, _, submitted in in_flight.values()),
+                     key=lambda item: item[0], reverse=True)[:3]
+    stragglers = ', '.join(f'{(task if isinstance(task, str) else task[0]).split("/")[-1]}'
+                           f'{"" if isinstance(task, str) else f" (+{len(task) - 1})"} {age:.0f}s'
+                           for age, task in running)
+    return (f'{n_done}/{n_total} genomes, {bytes_done / 1e6:.0f}/{bytes_total / 1e6:.0f} Mb, {rate:.2f} Mb/s, '
+            f'ETA {eta}, longest running: {stragglers or "-"}')
+
+
+# memory estimate per task: (fixed bytes, bytes per input byte)
+MEMORY_MODEL = {
+    'minced': (512 << 20, 4.0),  # JVM heap + the sequence held as UTF-16 strings
+    'native': (100 << 20, 40.0),  # 2-bit codes + int64 k-mer hashes and their argsort
+}
+
+
+ENGINES = {
+    'minced': (locate_array_kmers, concurrent.futures.ThreadPoolExecutor),  # threads only wait on the JVM
+    'native': (locate_array_native, concurrent.futures.ProcessPoolExecutor),  # CPU-bound, needs processes
+}
 
 
 if __name__ == '__main__':
@@ -45,6 +494,55 @@ if __name__ == '__main__':
                         help='<-sMax 80> The maximal length of the spacer, default=80')
     parser.add_argument('-n', '--num_threads', type=int, required=False, default=os.cpu_count(),
                         help='<-n 5> Number of threads (default n = all cpus), all threads  will be used if not given')
+    parser.add_argument('--engine', choices=list(ENGINES), default='minced',
+                        help='<--engine native> Array caller: minced (default, one JVM per fasta) or native '
+                             '(in-process NumPy repeat finder with the same parameters and GFF output)')
+    parser.add_argument('--batch_bytes', type=int, required=False, default=0,
+                        help='<--batch_bytes 50000000> minced engine only: concatenate small fasta files into one minced '
+                             'run of about this many bytes to save JVM start-ups, default=0 (one minced run per file)')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='Only send scaffolds with exact k-mers repeated -rN times at repeat+spacer spacing to the '
+                             'array caller; genomes without such repeats are skipped')
+    parser.add_argument('--prefilter_benchmark', type=str, required=False, default=None,
+                        help='<--prefilter_benchmark full_run/minced_out2fna.tsv> Measure prefilter recall against the '
+                             'arrays of an unfiltered run over the same input, write prefilter_benchmark.tsv and exit')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Hash every scaffold and scan each distinct sequence once; arrays are copied to all '
+                             'genomes that share the scaffold (writes scaffold_digests.tsv and unique_scaffolds/)')
+    parser.add_argument('--max_in_flight', type=int, required=False, default=None,
+                        help='<--max_in_flight 64> Genomes (or minced batches) queued at once, default=2 x num_threads')
+    parser.add_argument('--timeout_base', type=float, required=False, default=120,
+                        help='<--timeout_base 120> minced timeout in seconds for an empty input, default=120')
+    parser.add_argument('--timeout_per_mb', type=float, required=False, default=10,
+                        help='<--timeout_per_mb 10> Seconds added to the minced timeout per Mb of (uncompressed) input, '
+                             'default=10')
+    parser.add_argument('--retries', type=int, required=False, default=1,
+                        help='<--retries 1> Reruns of a timed-out genome (doubling the timeout) before it is written to '
+                             'quarantine.tsv, default=1')
+    parser.add_argument('--mem-budget', '--mem_budget', dest='mem_budget', type=parse_size, required=False,
+                        default=None,
+                        help='<--mem-budget 200G> RAM budget for concurrent array calls; tasks are admitted while '
+                             'their size-based memory estimates fit, default=no limit')
+    parser.add_argument('--mem_factor', type=float, required=False, default=None,
+                        help='<--mem_factor 4> Estimated bytes of memory per byte of (uncompressed) input, default=4 '
+                             '(minced) or 40 (native)')
+    parser.add_argument('--resume_key', choices=['stat', 'hash'], default='stat',
+                        help='<--resume_key hash> How array_scan_manifest.tsv recognises an already scanned genome: '
+                             'stat (path, size and mtime, default) or hash (sha1 of the file content)')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Ignore array_scan_manifest.tsv and scan every genome again')
+    parser.add_argument('--store', choices=['files', 'parquet'], default='files',
+                        help='<--store parquet> Where array calls go: files (one repeat_info/*_minced_out.txt per '
+                             'genome, default) or parquet (one partitioned dataset repeat_store/, needs pyarrow)')
+    parser.add_argument('--scratch_dir', type=str, required=False, default=tempfile.gettempdir(),
+                        help='<--scratch_dir /local/tmp> --store parquet: node-local directory for the short-lived '
+                             'per-genome minced output, default=the system temp directory')
+    parser.add_argument('--store_flush_rows', type=int, required=False, default=200000,
+                        help='<--store_flush_rows 200000> --store parquet: arrays buffered before a part file is '
+                             'written, default=200000')
+    parser.add_argument('--progress_interval', type=float, required=False, default=60,
+                        help='<--progress_interval 60> Seconds between live throughput/ETA/straggler lines, 0 = off, '
+                             'default=60')
     parser.add_argument('-o', '--outdir', type=str, required=True,
                         help='<-o /test/output> An absolute directory to save output files. e.g., user/output')
     # parser.add_argument('-tsv', '--output_tsv', type=str, required=True,
@@ -65,40 +563,189 @@ if __name__ == '__main__':
     df_file_list = df['file_path'].to_list()
 
     start = time.time()
-    batch_size = 10000
-
-    # List to store input-output file path pairs
-    file_pairs = []
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_threads) as executor:
-        for i in range(0, len(df_file_list), batch_size):
-            batch = df_file_list[i:i + batch_size]
-            try:
-                futures = [
-                    executor.submit(
-                        locate_array_kmers,
-                        args.repeat_number,
-                        args.repeat_minimal_length,
-                        args.repeat_maximal_length,
-                        args.spacer_minimal_length,
-                        args.spacer_maximal_length,
-                        fna,
-                        f'{args.outdir}/repeat_info/{fna.split("/")[-1]}_minced_out.txt',
-                        logger
-                    ) for fna in batch
-                ]
-
-                for future in concurrent.futures.as_completed(futures):
-                    input_file, output_file = future.result()
-                    if output_file is not None:  # Only append if output_file is not None
-                        file_pairs.append((input_file, output_file))
-
-            except Exception as e:
-                logger.exception(f"An error occurred while processing the batch: {e}")
-
-    # Save the input-output file paths to a TSV file
+
+    if args.prefilter_benchmark:
+        params = dict(num_of_repeats=args.repeat_number, rep_min=args.repeat_minimal_length,
+                      rep_max=args.repeat_maximal_length, spa_min=args.spacer_minimal_length,
+                      spa_max=args.spacer_maximal_length)
+        prefilter_benchmark(df_file_list, args.prefilter_benchmark, params, args.num_threads, args.outdir)
+        print(f'Total finished in {round(time.time() - start, 2)} seconds\n')
+        sys.exit(0)
+
+    genome_list = df_file_list
+    if args.dedup:
+        df_file_list = dedup_scaffolds(genome_list, args.outdir, args.num_threads)
+
+    # progress manifest: one appended line per finished genome, so a rerun only scans new or changed genomes
+    manifest_path = f'{args.outdir}/array_scan_manifest.tsv'
+    manifest = {} if args.rescan else load_manifest(manifest_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_threads) as hasher:
+        file_keys = {key[0]: key for key in hasher.map(lambda fna: file_key(fna, args.resume_key), df_file_list)}
+    all_file_list = df_file_list
+    unreadable = [fna for fna, key in file_keys.items() if key[1] is None]
+    df_file_list = [fna for fna in all_file_list if file_keys[fna][1] is not None
+                    and not is_done(manifest.get(fna), file_keys[fna], args.resume_key)]
+    print(f'{len(all_file_list) - len(df_file_list) - len(unreadable)} genomes already scanned, '
+          f'{len(df_file_list)} to scan, {len(unreadable)} unreadable')
+
+    write_header = not os.path.exists(manifest_path) or os.path.getsize(manifest_path) == 0
+    manifest_file = open(manifest_path, 'a')
+    if write_header:
+        manifest_file.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+    for fna in unreadable:
+        # logged and left out of the scan like a genome minced failed on; retried on the next run
+        logger.error(f'Cannot read {fna}, skipped')
+        manifest_file.write(f'{fna}\t\t\t\t\terror\n')
+    manifest_file.flush()
+    # memory estimates, timeouts, batches and the scan order go by the fasta the caller reads: the uncompressed size
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_threads) as sizer:
+        scan_bytes = dict(zip(df_file_list, sizer.map(fasta_io.uncompressed_size, df_file_list)))
+
+    # --store parquet: minced writes to node-local scratch, the records are folded into repeat_store/ and the
+    # scratch file is removed, so the shared output directory only sees a few large parquet parts
+    store = None
+    work_dir = args.outdir
+    held_manifest = []  # manifest lines of genomes whose arrays are not flushed to the store yet
+    if args.store == 'parquet':
+        import array_store  # optional (pyarrow), only needed for --store parquet
+        store = array_store.ArrayStoreWriter(f'{args.outdir}/repeat_store', args.store_flush_rows)
+        work_dir = tempfile.mkdtemp(prefix='array_scan_', dir=args.scratch_dir)
+        os.makedirs(f'{work_dir}/repeat_info')
+
+    def flush_store():
+        # arrays reach the store before their manifest lines, so a crash never marks an unsaved genome as done
+        store.flush()
+        manifest_file.writelines(held_manifest)
+        manifest_file.flush()
+        held_manifest.clear()
+
+    # largest genomes first, so the big ones do not end up alone at the tail of the run
+    df_file_list.sort(key=lambda fna: scan_bytes[fna], reverse=True)
+    n_total, bytes_total = len(df_file_list), sum(file_keys[fna][1] for fna in df_file_list)
+    locate_array, executor_class = ENGINES[args.engine]
+    if args.engine == 'minced' and args.batch_bytes > 0:
+        df_file_list = batch_by_size(df_file_list, args.batch_bytes, scan_bytes)
+        locate_array = locate_array_batch
+        print(f'{sum(len(b) for b in df_file_list)} fasta files grouped into {len(df_file_list)} minced runs')
+
+    max_in_flight = args.max_in_flight or 2 * args.num_threads
+    base_bytes, mem_factor = MEMORY_MODEL[args.engine]
+    memory = MemoryBudget(args.mem_budget, base_bytes, args.mem_factor or mem_factor)
+    pending = collections.deque((task, 0) for task in df_file_list)  # (fna or list of fna, attempt)
+    in_flight = {}
+    quarantine_path = f'{args.outdir}/quarantine.tsv'
+    # one JSON row per genome and attempt: input_bytes, scaffolds, wall_s, cpu_s, peak_rss, arrays, returncode,
+    # status, ...
+    metrics_file = open(f'{args.outdir}/array_scan_metrics.jsonl', 'a')
+    n_done = bytes_done = 0
+    scanned = set()  # genomes (--dedup: unique scaffold fasta) scanned to the end in this run
+    slowest = []  # (wall_s, fna_path, input_bytes, cpu_s) of the slowest finished genomes
+    scan_start = last_progress = time.time()
+    with executor_class(max_workers=args.num_threads) as executor, kill_children_on_exit():
+        while pending or in_flight:
+            # keep a bounded window of queued work instead of waiting on fixed slices
+            while pending and len(in_flight) < max_in_flight:
+                task, attempt = pending[0]
+                task_bytes = sum(scan_bytes[fna] for fna in (task if isinstance(task, list) else [task]))
+                cost = memory.estimate(task_bytes)
+                if not memory.try_admit(cost):
+                    break  # wait for running tasks to give memory back
+                pending.popleft()
+                future = executor.submit(
+                    locate_array,
+                    args.repeat_number,
+                    args.repeat_minimal_length,
+                    args.repeat_maximal_length,
+                    args.spacer_minimal_length,
+                    args.spacer_maximal_length,
+                    task,
+                    work_dir if locate_array is locate_array_batch else
+                    f'{work_dir}/repeat_info/{task.split("/")[-1]}_minced_out.txt',
+                    logger,
+                    task_timeout(task_bytes, attempt, args.timeout_base, args.timeout_per_mb),
+                    args.prefilter
+                )
+                in_flight[future] = (task, attempt, cost, time.time())
+
+            done, _ = concurrent.futures.wait(in_flight, timeout=args.progress_interval or None,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task, attempt, cost, _ = in_flight.pop(future)
+                memory.release(cost)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.exception(f"An error occurred while processing {task}: {e}")
+                    continue
+                for input_file, output_file, status, metrics in (result if isinstance(result, list) else [result]):
+                    _, size, mtime, digest = file_keys[input_file]
+                    row = {key: round(value, 3) if isinstance(value, float) else value for key, value in metrics.items()}
+                    metrics_file.write(json.dumps(dict(row, status=status, attempt=attempt, engine=args.engine,
+                                                       finished=round(time.time(), 3))) + '\n')
+                    if status == 'timeout' and attempt < args.retries:
+                        # retried alone and first in line, so one straggler cannot hold up a whole batch again
+                        retry = [input_file] if isinstance(task, list) else input_file
+                        pending.appendleft((retry, attempt + 1))
+                        continue
+                    if status == 'timeout':
+                        new_quarantine = not os.path.exists(quarantine_path)
+                        with open(quarantine_path, 'a') as quarantine:
+                            if new_quarantine:
+                                quarantine.write('fna_path\tsize\tattempts\n')
+                            quarantine.write(f'{input_file}\t{size}\t{attempt + 1}\n')
+                        print(f'quarantined {input_file} after {attempt + 1} timed-out minced runs')
+                    n_done += 1
+                    bytes_done += size
+                    if status == 'done':
+                        scanned.add(input_file)
+                    slowest = sorted(slowest + [(metrics['wall_s'], input_file, size, metrics['cpu_s'])],
+                                     reverse=True)[:5]
+                    if store is not None and status == 'done':
+                        # also without arrays: the genome's rows from an earlier scan are no longer read
+                        if output_file:
+                            with open(output_file) as gff:
+                                store.add_gff(input_file, gff)
+                            os.remove(output_file)
+                        else:
+                            store.add_gff(input_file, [])
+                        held_manifest.append(f'{input_file}\t{size}\t{mtime}\t{digest}\t'
+                                             f'{store.store_dir if output_file else ""}\t{status}\n')
+                        continue
+                    manifest_file.write(f'{input_file}\t{size}\t{mtime}\t{digest}\t{output_file or ""}\t{status}\n')
+                manifest_file.flush()
+                metrics_file.flush()
+                if store is not None and store.full():
+                    flush_store()
+            if args.progress_interval and time.time() - last_progress >= args.progress_interval:
+                print(progress_line(n_done, n_total, bytes_done, bytes_total, time.time() - scan_start, in_flight),
+                      flush=True)
+                last_progress = time.time()
+
+    metrics_file.close()
+    if n_total:
+        print(progress_line(n_done, n_total, bytes_done, bytes_total, time.time() - scan_start, in_flight))
+    for wall_s, fna, size, cpu_s in slowest:
+        # cpu/wall far below 1 points at I/O (or a JVM waiting on it), near 1 at the caller itself
+        print(f'slowest: {fna} {size / 1e6:.1f} Mb in {wall_s:.1f}s (cpu/wall {cpu_s / max(wall_s, 1e-6):.2f})')
+
+    if store is not None:
+        flush_store()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if os.path.isdir(f'{args.outdir}/tmp_batches') and not os.listdir(f'{args.outdir}/tmp_batches'):
+        os.rmdir(f'{args.outdir}/tmp_batches')
+
+    manifest_file.close()
+
+    # Save the input-output file paths to a TSV file, rebuilt from the manifest so earlier runs are included
+    manifest = load_manifest(manifest_path)
+    if args.dedup:
+        file_pairs = fan_out_arrays(genome_list, args.outdir, manifest, scanned, store)
+    else:
+        file_pairs = [(fna, manifest[fna].file_path) for fna in dict.fromkeys(all_file_list)
+                      if fna in manifest and manifest[fna].status == 'done' and manifest[fna].file_path]
     output_df = pd.DataFrame(file_pairs, columns=['fna_path', 'file_path'])
     output_df.to_csv(f'{args.outdir}/minced_out2fna.tsv', sep='\t', index=False)
 
+    print(memory.report())
     print(f'Total finished in {round(time.time() - start, 2)} seconds\n')
     # 90 Gb fna file -> 4090.61 s
\ No newline at end of file
@@ -1,9 +1,14 @@
-import os.path, itertools,re
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import os.path, itertools, collections, functools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
-import time, subprocess
+import numpy as np
+import time, sys
 from pathlib import Path
 from Bio import SeqIO
+from resource_limiter import MemoryBudget, parse_size
+import fasta_io
+from gene_callers import GENE_CALLERS
+import orf_kernels
 
 
 def ensure_paths(paths):
@@ -22,84 +27,418 @@ def minced_to_fna(minced_out_path, save_dir=None):
     return df_minced_path
 
 
-def get_sequences(column, prodigal_faa_path, window):
+GFF_COLUMNS = ['scaffold', 'source', 'repeat_region', 'start', 'end', 'repeat_number', 'unk_1', 'unk_2', 'attributes']
+
+
+def read_minced(minced_path, fna_path):
+    # arrays of one genome: its minced GFF file, or its rows in the repeat_store/ of 01_array.py --store parquet
+    if os.path.isdir(minced_path):
+        import array_store  # optional (pyarrow), only needed for --store parquet
+        return array_store.read_arrays(minced_path, fna_path)
+    return pd.read_csv(minced_path, sep='\t', comment='#', header=None, names=GFF_COLUMNS)
+
+
+def load_records(fna_path, scaffolds):
+    # only the scaffolds that carry an array are kept
+    scaffolds = set(scaffolds)
+    with fasta_io.open_fasta(fna_path) as handle:
+        return {record.id: record for record in SeqIO.parse(handle, 'fasta') if record.id in scaffolds}
+
+
+def load_windows(fna_path, df_arrays, window, index_dir=None):
+    # (scaffold length, window offset, window sequence as bytes) per array: plain and bgzip genomes are sliced through
+    # a persistent faidx index, only gzip/zstd genomes are still parsed (keeping just the scaffolds with arrays, whose
+    # bytes are shared by all arrays of the scaffold)
+    scaffolds = df_arrays['scaffold'].astype(str)
+    if fasta_io.compression(fna_path) in (None, 'bgzip'):
+        with fasta_io.IndexedFasta(fna_path, index_dir) as fasta:
+            return [(fasta.length(scaffold), max(0, start - 1 - window),
+                     fasta.fetch_bytes(scaffold, start - 1 - window, end + window))
+                    for scaffold, start, end in zip(scaffolds, df_arrays['start'], df_arrays['end'])]
+    sequences = {scaffold: bytes(record.seq) for scaffold, record in load_records(fna_path, scaffolds).items()}
+    return [(len(sequences[scaffold]), 0, sequences[scaffold]) for scaffold in scaffolds]
+
+
+def window_bounds(column, window):
+    # 0-based [start, end) of the array's +-window region on its scaffold
+    return max(0, column['start'] - 1 - window), min(column['end'] + window, int(column['sequence_length']))
+
+
+def window_region(column, window):
+    # zero-copy view of the array's +-window region and its start on the scaffold (column['sequence'] only holds the
+    # scaffold from column['window_start'] on)
+    cds_start, cds_end = window_bounds(column, window)
+    region = memoryview(column['sequence'])[cds_start - column['window_start']: cds_end - column['window_start']]
+    return region, cds_start
+
+
+def masked_windows(df_arrays, window):
+    # (faa_file_name, window with its array masked by N) per array, masked in place in one reused buffer: each view is
+    # only valid until the next one is taken, so gene callers consume (or copy) the windows in turn
+    buffer = bytearray()
+    for _, row in df_arrays.iterrows():
+        region, cds_start = window_region(row, window)
+        buffer[:] = region
+        start, end = row['start'] - 1 - cds_start, row['end'] - cds_start
+        buffer[start:end] = b'N' * (end - start)
+        with memoryview(buffer) as masked:
+            yield row['faa_file_name'], masked
+
+
+def mask_window(column, window, keep_masked=True):
     # input infor
     start = column['start'] - 1
     end = column['end']
-    sequence = column['sequence']
-    repeat_sequence = sequence.seq[start: end]  # sequence object
-    faa_file_name = column['faa_file_name']
 
-    cds_start = max(0, start - window)
-    cds_end = min(end + window, int(column['sequence_length']))
-    cds_masked = sequence.seq[cds_start: start] + (end - start) * 'N' + sequence.seq[end:cds_end]
+    region, cds_start = window_region(column, window)
+    region = str(region, 'ISO-8859-1')
+    repeat_sequence = region[start - cds_start: end - cds_start]
+    # the masked window as text is only kept for the full single_csv_and_faa/*.csv
+    cds_masked = region[:start - cds_start] + (end - start) * 'N' + region[end - cds_start:] if keep_masked else None
 
     # new start and end of repeat region
     new_positions = [start - cds_start, end - cds_start]
+    return repeat_sequence, region, cds_masked, new_positions
+
+
+def merged_cds(df_arrays, window, faa_file_path, call_genes):
+    # --merge_windows: overlapping windows of one scaffold are unioned into one region with all its arrays masked and
+    # predicted once; every CDS is given to each array whose window holds the CDS midpoint, in window coordinates
+    regions = []  # [region start, region end, masked region, [(faa_file_name, window start, window end)]]
+    rows = sorted((row for _, row in df_arrays.iterrows()), key=lambda row: (str(row['scaffold']), row['start']))
+    for scaffold, group in itertools.groupby(rows, key=lambda row: str(row['scaffold'])):
+        region = None
+        for row in group:
+            cds_start, cds_end = window_bounds(row, window)
+            if region is None or cds_start > region[1]:
+                region = [cds_start, cds_start, [], []]
+                regions.append(region)
+            if cds_end > region[1]:  # extend the region with the part of this window not covered yet
+                region[2].append(memoryview(row['sequence'])[region[1] - row['window_start']:
+                                                             cds_end - row['window_start']])
+                region[1] = cds_end
+            region[3].append((row['faa_file_name'], cds_start, cds_end, row['start'] - 1, row['end']))
 
-    # run prodigal
-    seq = f'>seq\n{cds_masked}'
-    faa_file_path = f"{prodigal_faa_path}/{faa_file_name}.faa"
-    command = ['prodigal', '-a', faa_file_path, '-q', '-p', 'meta', '-f', 'gff', '-m']
-    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    input_data = seq.encode('utf-8')
-    output_data, _ = process.communicate(input_data)
+    records = []
+    for n, (region_start, _, pieces, arrays) in enumerate(regions):
+        sequence = bytearray(b''.join(pieces))
+        for _, _, _, start, end in arrays:
+            sequence[start - region_start: end - region_start] = b'N' * (end - start)
+        records.append((f'{arrays[0][0]}__merged', sequence))
+    cds_by_region = call_genes(records, faa_file_path)
 
-    # get cds list and distance to array
-    cds_dict = SeqIO.to_dict(SeqIO.parse(faa_file_path, 'fasta'))
-    cds_list = [str(cds.seq) for cds in cds_dict.values()]
+    cds_by_window = collections.defaultdict(list)
+    for (region_start, _, _, arrays), (name, _) in zip(regions, records):
+        for protein, cds_start, cds_end in cds_by_region.get(name, []):
+            midpoint = region_start + (cds_start + cds_end) / 2 - 1
+            for faa_file_name, window_start, window_end, _, _ in arrays:
+                if window_start <= midpoint < window_end:
+                    shift = region_start - window_start
+                    cds_by_window[faa_file_name].append((protein, cds_start + shift, cds_end + shift))
+    return cds_by_window
+
+
+def get_sequences(column, window, cds_by_window, positions, keep_masked=True):
+    repeat_sequence, region, cds_masked, new_positions = mask_window(column, window, keep_masked)
+
+    # get cds list and its distance / orf number (e.g., 4, 3, 2, 1, [repeat], 1, 2, 3, 4) relative to the array
+    cds_list = [protein for protein, _, _ in cds_by_window.get(column['faa_file_name'], [])]
 
     if cds_list:
-        cds_start_end = [[cds.description.split(' # ')[1],cds.description.split(' # ')[2]] for cds in cds_dict.values()]
-        cds2rep_dist_abs = [
-            min([abs(a - int(b)) for a, b in itertools.product(new_positions, cds_start_end[i])])
-            for i in range(len(cds_start_end))
-        ]
-
-        # get cds label, e.g., -4,-3,-2, -1, [repeat], 1, 2, 3, 4......
-        cds_start_end = [[int(x), int(y)] for x, y in cds_start_end]
-        cds_start_end.append(new_positions)
-        cds_start_end.sort(key=lambda x: x[0])
-        index_of_new_positions = cds_start_end.index(new_positions)
-        elements_before = [i for i in range(index_of_new_positions, 0, -1)]
-        elements_after = len(cds_start_end) - index_of_new_positions - 1
-        elements_after = [i for i in range(elements_after + 1) if i > 0]
-        elements_before.extend(elements_after)  # number of orf relative to array
-
-        return repeat_sequence, sequence.seq[cds_start:cds_end], cds_masked, cds_list, cds2rep_dist_abs, elements_before,new_positions
-
-
-def x(minced_path, fna_path, faa_path, minced2fna_csv_path, window):
+        cds2rep_dist_abs, elements_before = positions[column['faa_file_name']]
+        return repeat_sequence, region, cds_masked, cds_list, cds2rep_dist_abs, elements_before,new_positions
+
+
+def cds_arrays(df_arrays, cds_by_window):
+    # flat CDS starts/ends and per-array counts of the arrays' CDS, the input of the orf_kernels
+    cds = [cds_by_window.get(faa_file_name, []) for faa_file_name in df_arrays['faa_file_name']]
+    starts = np.fromiter((start for array_cds in cds for _, start, _ in array_cds), dtype=np.int64)
+    ends = np.fromiter((end for array_cds in cds for _, _, end in array_cds), dtype=np.int64)
+    return cds, starts, ends, np.array([len(array_cds) for array_cds in cds], dtype=np.int64)
+
+
+def cds_positions(df_arrays, window, cds_by_window):
+    # cds2rep_dist and num_th_orf of every array's CDS, computed for all arrays of the genome at once
+    cds, starts, ends, counts = cds_arrays(df_arrays, cds_by_window)
+    window_starts = np.maximum(0, df_arrays['start'].to_numpy(dtype=np.int64) - 1 - window)
+    dist, num_th_orf = orf_kernels.cds_positions(starts, ends, counts,
+                                                 df_arrays['start'].to_numpy(dtype=np.int64) - 1 - window_starts,
+                                                 df_arrays['end'].to_numpy(dtype=np.int64) - window_starts)
+    splits = np.cumsum(counts)[:-1]
+    return {faa_file_name: (array_dist.tolist(), array_num_th_orf.tolist()) for faa_file_name, array_dist,
+            array_num_th_orf in zip(df_arrays['faa_file_name'], np.split(dist, splits), np.split(num_th_orf, splits))}
+
+
+def derive_window(df_arrays, window, max_window, cds_by_window):
+    # window sweep: the CDS called at max_window, shifted into each array's smaller window; CDS reaching over its edge
+    # are clipped to it (the protein is kept whole) and flagged as edge-truncated
+    cds, starts, ends, counts = cds_arrays(df_arrays, cds_by_window)
+    array_starts = df_arrays['start'].to_numpy(dtype=np.int64) - 1
+    array_ends = df_arrays['end'].to_numpy(dtype=np.int64)
+    lengths = df_arrays['sequence_length'].to_numpy(dtype=np.int64)
+    max_starts = np.maximum(0, array_starts - max_window)
+    cds_starts = np.maximum(0, array_starts - window)
+    kept, starts, ends, flags = orf_kernels.shift_to_window(starts, ends, counts, max_starts - cds_starts,
+                                                            np.minimum(array_ends + window, lengths) - cds_starts)
+    cds_derived, truncated, n = {}, {}, 0
+    for faa_file_name, array_cds in zip(df_arrays['faa_file_name'], cds):
+        kept_index = [i for i in range(n, n + len(array_cds)) if kept[i]]
+        cds_derived[faa_file_name] = [(array_cds[i - n][0], int(starts[i]), int(ends[i])) for i in kept_index]
+        truncated[faa_file_name] = [bool(flags[i]) for i in kept_index]
+        n += len(array_cds)
+    return cds_derived, truncated
+
+
+def pair_rows(df_arrays, window, cds_by_window, keep_masked=True):
+    if df_arrays.empty:
+        return None
+    positions = cds_positions(df_arrays, window, cds_by_window)
+    seq_infor = df_arrays.apply(
+        lambda column: pd.Series(get_sequences(column, window, cds_by_window, positions, keep_masked)), axis=1)
+    # arrays without CDS keep their row with empty fields, also when none of the (split) genome's arrays has one
+    seq_infor = seq_infor.reindex(columns=range(7))
+    seq_infor.columns = ['repeat_sequence', 'cds_region', 'cds_masked', 'cds_list', 'cds2rep_dist',
+                         'num_th_orf', 'repeat_start_end']
+    return pd.concat([df_arrays, seq_infor], axis=1)
+
+
+PAIR_COLUMNS = ['faa_file_name', 'cds_region', 'repeat_sequence', 'cds_list', 'cds2rep_dist', 'num_th_orf',
+                'repeat_number', 'repeat_unit', 'repeat_start_end']
+
+
+PAIR_HEADER = ['faa_file_name', 'cds_region', 'repeat_region', 'cds_list', 'cds2rep_dist', 'num_th_orf',
+               'repeat_number', 'rpt_unit_seq', 'repeat_start_end']
+
+
+def pairs_schema(sweep=None):
+    # --output_format parquet: typed columns, the lists of the tsv output as native list columns
+    import pyarrow as pa  # optional, only needed for --output_format parquet
+    types = [pa.string(), pa.string(), pa.string(), pa.list_(pa.string()), pa.list_(pa.int64()),
+             pa.list_(pa.int64()), pa.int64(), pa.string(), pa.list_(pa.int64())]
+    fields = list(zip(PAIR_HEADER, types))
+    if sweep:
+        fields.append(('edge_truncated', pa.list_(pa.bool_())))
+    return pa.schema(fields)
+
+
+def pairs_table(frames, schema):
+    # result frames of x() -> one arrow table; arrays without CDS keep nulls where the tsv has empty fields
+    import pyarrow as pa
+    df_pairs = pd.concat(frames)
+    return pa.table([pa.array([None if isinstance(value, float) and value != value else value
+                               for value in df_pairs[column].tolist()], type=field.type)
+                     for column, field in zip(df_pairs.columns, schema)], schema=schema)
+
+
+def plan_dedup(df_minced2fna, digest_tsv):
+    # identical scaffolds (same digest in scaffold_digests.tsv from 01_array.py --dedup) give identical windows and
+    # ORFs around the same array coordinates: compute each (digest, start, end) once and copy it to the others
+    df_digest = pd.read_csv(digest_tsv, sep='\t', usecols=['fna_path', 'scaffold', 'digest'], dtype=str)
+    digest_of = dict(zip(zip(df_digest['fna_path'], df_digest['scaffold']), df_digest['digest']))
+    del df_digest
+    owners = {}
+    compute = collections.defaultdict(set)  # fna_path -> faa_file_names computed from this genome
+    copies = collections.defaultdict(dict)  # fna_path -> {faa_file_name: faa_file_names of the copies}
+    for minced_path, fna_path in zip(df_minced2fna['file_path'], df_minced2fna['fna_path']):
+        df_arrays = read_minced(minced_path, fna_path)[['scaffold', 'start', 'end']].astype(str)
+        for scaffold, start, end in df_arrays.itertuples(index=False):
+            faa_file_name = f'{scaffold}__{start}_{end}'
+            key = (digest_of.get((fna_path, scaffold), (fna_path, scaffold)), start, end)
+            if key in owners:
+                owner_fna, owner_name = owners[key]
+                copies[owner_fna].setdefault(owner_name, []).append(faa_file_name)
+            else:
+                owners[key] = (fna_path, faa_file_name)
+                compute[fna_path].add(faa_file_name)
+    return compute, copies
+
+
+def fan_out(result, copies):
+    # append a copy of every computed array row for each duplicate array, renamed to the duplicate's scaffold
+    extra = [(i, name) for i, faa_file_name in enumerate(result['faa_file_name'])
+             for name in copies.get(faa_file_name, [])]
+    if not extra:
+        return result
+    df_copies = result.iloc[[i for i, _ in extra]].copy()
+    df_copies['faa_file_name'] = [name for _, name in extra]
+    return pd.concat([result, df_copies])
+
+
+def prepare_arrays(minced_path, fna_path, window, arrays=None, index_dir=None):
+    # Parse minced_output
+    df_minced_out = read_minced(minced_path, fna_path)
+    if arrays is not None:  # --dedup: only the arrays this genome is the first to carry
+        faa_file_names = df_minced_out['scaffold'].astype(str) + '__' + df_minced_out['start'].astype(str) + \
+            '_' + df_minced_out['end'].astype(str)
+        df_minced_out = df_minced_out[faa_file_names.isin(arrays)].reset_index(drop=True)
+    # only the +-window bp around each array are read from the genome
+    windows = load_windows(fna_path, df_minced_out, window, index_dir)
+    df_minced_out['repeat_unit'] = df_minced_out['attributes'].apply(lambda x: x.split('rpt_unit_seq=')[-1])
+    df_minced_out['sequence_length'] = [length for length, _, _ in windows]
+    df_minced_out['window_start'] = [window_start for _, window_start, _ in windows]
+    df_minced_out['sequence'] = [sequence for _, _, sequence in windows]
+    df_minced_out['faa_file_name'] = df_minced_out.apply(
+        lambda row: f"{row['scaffold']}__{row['start']}_{row['end']}", axis=1
+    )
+    return df_minced_out
+
+
+def gene_caller_benchmark(df_minced2fna, window, index_dir, faa_path, outdir):
+    # run every --gene-caller on the masked windows of the input genomes (one call per genome, one process), compare
+    # the calls with those of the per-window prodigal reference and report the throughput; False if the reference
+    # could not be run (no comparison was made)
+    genomes = []
+    for minced_path, fna_path in zip(df_minced2fna['file_path'], df_minced2fna['fna_path']):
+        df_arrays = prepare_arrays(minced_path, fna_path, window, index_dir=index_dir)
+        genomes.append((f'{faa_path}/{os.path.basename(fna_path)}.faa',
+                        [(name, bytes(masked)) for name, masked in masked_windows(df_arrays, window)]))
+    n_windows = sum(len(windows) for _, windows in genomes)
+    n_bp = sum(len(masked) for _, windows in genomes for _, masked in windows)
+
+    rows, reference, reference_name = [], None, 'prodigal'
+    for name, call_genes in GENE_CALLERS.items():
+        try:
+            started = time.perf_counter()
+            calls = [call_genes(windows, faa_file_path) for faa_file_path, windows in genomes]
+            seconds = time.perf_counter() - started
+        except (ImportError, OSError) as e:
+            print(f'{name}: not available ({e})')
+            continue
+        calls = [{window: list(cds_by_window.get(window, [])) for window, _ in windows}
+                 for (_, windows), cds_by_window in zip(genomes, calls)]
+        if name == reference_name:
+            reference = calls
+        differing, compared = None, f'not compared ({reference_name} reference not available)'
+        if reference is not None:
+            differing = sum(genome[window] != reference_genome[window]
+                            for genome, reference_genome in zip(calls, reference) for window in genome)
+            compared = f'{differing} windows differ from {reference_name}'
+        n_cds = sum(len(cds) for genome in calls for cds in genome.values())
+        rows.append((name, len(genomes), n_windows, n_cds, round(seconds, 3), round(n_windows / seconds, 2),
+                     round(n_bp / 1e6 / seconds, 3), differing, reference_name if reference is not None else ''))
+        print(f'{name}: {n_windows} windows ({n_cds} CDS) in {seconds:.2f}s, {n_windows / seconds:.1f} windows/s, '
+              f'{n_bp / 1e6 / seconds:.2f} Mb/s, {compared}')
+    pd.DataFrame(rows, columns=['gene_caller', 'genomes', 'windows', 'cds', 'seconds', 'windows_per_s', 'mb_per_s',
+                                'windows_differing', 'reference']).to_csv(f'{outdir}/gene_caller_benchmark.tsv',
+                                                                          sep='\t', index=False)
+    return reference is not None
+
+
+def x(minced_path, fna_path, faa_path, minced2fna_csv_path, window, arrays=None, index_dir=None, merge=False,
+      gene_caller='batched', sweep=None, part=None, single_csv='full'):
     try:
-        # Parse minced_output
-        df_minced_out = pd.read_csv(minced_path, sep='\t', comment='#', header=None,
-                                    names=['scaffold', 'source', 'repeat_region', 'start', 'end',
-                                           'repeat_number', 'unk_1', 'unk_2', 'attributes']
-                                    )
-        # fna fasta to dict
-        record_dict = SeqIO.to_dict(SeqIO.parse(open(fna_path, 'r', encoding='ISO-8859-1'), 'fasta'))
-        df_minced_out['repeat_unit'] = df_minced_out['attributes'].apply(lambda x: x.split('rpt_unit_seq=')[-1])
-        df_minced_out['sequence'] = df_minced_out['scaffold'].map(record_dict)
-        df_minced_out['sequence_length'] = df_minced_out['sequence'].map(lambda sequence: len(sequence))
-        df_minced_out['faa_file_name'] = df_minced_out.apply(
-            lambda row: f"{row['scaffold']}__{row['start']}_{row['end']}", axis=1
-        )
-
-        # Process sequences and extract information
-        seq_infor = df_minced_out.apply(lambda column: pd.Series(get_sequences(column, faa_path, window)), axis=1)
-        if not seq_infor.empty:
-            seq_infor.columns = ['repeat_sequence', 'cds_region', 'cds_masked', 'cds_list', 'cds2rep_dist',
-                                 'num_th_orf', 'repeat_start_end']
-            df_minced_out = pd.concat([df_minced_out, seq_infor], axis=1)
-            minced_out_to_fna_name = os.path.basename(fna_path)
-            df_minced_out.dropna()
-            df_minced_out.to_csv(f'{minced2fna_csv_path}/{minced_out_to_fna_name}.csv', sep='\t', index=False)
-            return df_minced_out[['faa_file_name', 'cds_region', 'repeat_sequence', 'cds_list', 'cds2rep_dist',
-                                  'num_th_orf', 'repeat_number', 'repeat_unit', 'repeat_start_end']]
+        df_minced_out = prepare_arrays(minced_path, fna_path, window, arrays, index_dir)
+
+        # Process sequences and extract information, gene calling for all windows of the genome at once
+        cds_by_window = {}
+        part_name = os.path.basename(fna_path) + ('' if part is None else f'.part{part}')  # --split_bytes subsets
+        faa_file_path = f'{faa_path}/{part_name}.faa'
+        call_genes = GENE_CALLERS[gene_caller]
+        if merge and not df_minced_out.empty:
+            cds_by_window = merged_cds(df_minced_out, window, faa_file_path, call_genes)
+        elif not df_minced_out.empty:
+            cds_by_window = call_genes(masked_windows(df_minced_out, window), faa_file_path)
+        df_pairs = pair_rows(df_minced_out, window, cds_by_window, keep_masked=single_csv == 'full')
+        if df_pairs is not None:
+            df_pairs.dropna()
+            if single_csv == 'full':
+                df_pairs.assign(sequence=[str(sequence, 'ISO-8859-1') for sequence in df_pairs['sequence']]).to_csv(
+                    f'{minced2fna_csv_path}/{part_name}.csv', sep='\t', index=False)
+            elif single_csv == 'pairs':
+                df_pairs[PAIR_COLUMNS].to_csv(f'{minced2fna_csv_path}/{part_name}.csv', sep='\t', index=False,
+                                              header=PAIR_HEADER)
+            if sweep is None:
+                return df_pairs[PAIR_COLUMNS]
+            # window sweep (window = the largest): smaller windows are filtered from the same gene calls
+            results = {}
+            for sweep_window in sweep:
+                cds_derived, truncated = derive_window(df_minced_out, sweep_window, window, cds_by_window)
+                df_window = df_pairs if sweep_window == window else pair_rows(df_minced_out, sweep_window, cds_derived,
+                                                                              keep_masked=False)
+                if df_window is None:
+                    continue
+                df_window = df_window[PAIR_COLUMNS].copy()
+                df_window['edge_truncated'] = [truncated[name] if isinstance(cds_list, list) else None
+                                               for name, cds_list in zip(df_window['faa_file_name'],
+                                                                         df_window['cds_list'])]
+                results[sweep_window] = df_window
+            return results
     except Exception as e:
         return fna_path, e  # Return the file path and the error to be logged
 
 
+def serialize_pairs(df_pairs, output_format, schema=None):
+    # tsv lines, or an arrow IPC stream for parquet output: the parent only appends bytes, it never holds frames
+    if output_format == 'tsv':
+        return df_pairs.to_csv(header=False, index=False, sep='\t')
+    import pyarrow as pa
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_table(pairs_table([df_pairs], schema))
+    return sink.getvalue().to_pybytes()
+
+
+def pairs_worker(minced_path, fna_path, faa_path, minced2fna_csv_path, window, arrays=None, index_dir=None,
+                 merge=False, gene_caller='batched', sweep=None, copies=None, output_format='tsv', schema=None,
+                 part=None, single_csv='full'):
+    # x() plus the --dedup copies of this genome, returned as {window: serialized rows}
+    result = x(minced_path, fna_path, faa_path, minced2fna_csv_path, window, arrays, index_dir, merge, gene_caller,
+               sweep, part, single_csv)
+    if result is None or (isinstance(result, tuple) and isinstance(result[1], Exception)):
+        return result
+    try:
+        return {w: serialize_pairs(fan_out(df_pairs, copies) if copies else df_pairs, output_format, schema)
+                for w, df_pairs in (result if isinstance(result, dict) else {window: result}).items()}
+    except Exception as e:
+        return fna_path, e
+
+
+def split_genome(minced_path, fna_path, arrays, split_bytes, arrays_per_task, window, merge, index_dir):
+    # a big plain/bgzip genome -> subsets of about arrays_per_task arrays for separate workers, which all slice their
+    # windows from the same mmap'ed fasta (shared page cache, no per-worker copy); with merge, subsets are only cut
+    # between windows that do not overlap. None = keep the genome as one task
+    if not os.path.exists(fna_path) or os.path.getsize(fna_path) < split_bytes or \
+            fasta_io.compression(fna_path) not in (None, 'bgzip'):
+        return None
+    df_arrays = read_minced(minced_path, fna_path)
+    df_arrays['faa_file_name'] = df_arrays['scaffold'].astype(str) + '__' + df_arrays['start'].astype(str) + '_' + \
+        df_arrays['end'].astype(str)
+    if arrays is not None:
+        df_arrays = df_arrays[df_arrays['faa_file_name'].isin(arrays)]
+    if len(df_arrays) <= arrays_per_task:
+        return None
+    fasta_io.IndexedFasta(fna_path, index_dir).close()  # build the faidx once here, not in every worker
+
+    parts, part, previous, region_end = [], [], None, 0
+    for scaffold, start, end, faa_file_name in sorted(
+            df_arrays[['scaffold', 'start', 'end', 'faa_file_name']].astype({'scaffold': str}).itertuples(index=False)):
+        overlaps = merge and scaffold == previous and start - 1 - window < region_end
+        if len(part) >= arrays_per_task and not overlaps:
+            parts.append(part)
+            part = []
+        part.append(faa_file_name)
+        region_end = max(region_end, end + window) if scaffold == previous else end + window
+        previous = scaffold
+    parts.append(part)
+    return parts
+
+
+def genome_tasks(minced_to_fna, compute=None, split=None):
+    # (minced_path, fna_path, arrays, part) streamed from minced_out2fna.tsv in chunks, the genome list is never held
+    # whole; arrays/part are None unless --dedup or --split_bytes restrict a task to some of the genome's arrays
+    for df_chunk in pd.read_csv(minced_to_fna, sep='\t', chunksize=10000):
+        for minced_path, fna_path in df_chunk[['file_path', 'fna_path']].itertuples(index=False):
+            if compute is not None and fna_path not in compute:
+                continue
+            arrays = None if compute is None else compute[fna_path]
+            parts = split(minced_path, fna_path, arrays) if split is not None else None
+            if parts is None:
+                yield minced_path, fna_path, arrays, None
+                continue
+            for n, part in enumerate(parts):
+                yield minced_path, fna_path, set(part), n
+
+
 if __name__ == '__main__':
     start = time.perf_counter()
     import argparse
@@ -107,48 +446,142 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Define windows size and run prodigal')
     parser.add_argument('-i', '--input', type=str, required=True,
                         help='<-i ./minced_out2fna.tsv> The minced_out2fna.tsv obtained from 01_array.py')
-    parser.add_argument('-w', '--window', type=int, required=True, default=10000,
-                        help='<-w 10000> Base pairs to the array')
+    parser.add_argument('-w', '--window', type=lambda text: sorted({int(w) for w in text.split(',')}), required=True,
+                        default=10000,
+                        help='<-w 10000> Base pairs to the array; a list (-w 5000,10000,20000) calls genes once at the '
+                             'largest window and writes array2prot_pairs_w<window>.csv for each, with edge_truncated '
+                             'flags for CDS cut by a smaller window')
     parser.add_argument('-n', '--num_threads', type=int, required=False, default=os.cpu_count(),
                         help='<-n 5> Number of threads (default n=all cpus), all threads  will be used if not given')
+    parser.add_argument('--mem-budget', '--mem_budget', dest='mem_budget', type=parse_size, required=False,
+                        default=None,
+                        help='<--mem-budget 200G> RAM budget for the worker processes; genomes are admitted while '
+                             'their size-based memory estimates fit, default=no limit')
+    parser.add_argument('--mem_factor', type=float, required=False, default=3.0,
+                        help='<--mem_factor 3> Estimated bytes of worker memory per byte of (uncompressed) genome fasta, '
+                             'default=3')
+    parser.add_argument('--dedup', type=str, nargs='?', const='', default=None,
+                        help='<--dedup [scaffold_digests.tsv]> Compute arrays on identical scaffolds once and copy the '
+                             'rows to every genome; uses scaffold_digests.tsv from 01_array.py --dedup (default: next '
+                             'to the input tsv)')
+    parser.add_argument('--merge_windows', action='store_true',
+                        help='Union overlapping windows of arrays on the same scaffold and call genes once per merged '
+                             'region (all its arrays masked); each array keeps the CDS whose midpoint is in its window')
+    parser.add_argument('--gene-caller', '--gene_caller', dest='gene_caller', choices=list(GENE_CALLERS),
+                        default='batched',
+                        help='<--gene-caller pyrodigal> prodigal (one process and .faa per window), batched (one prodigal '
+                             'per genome, default) or pyrodigal (in-process, no fork or .faa files, needs pyrodigal)')
+    parser.add_argument('--gene_caller_benchmark', action='store_true',
+                        help='Run every gene caller on the windows of the input genomes, report differences to the '
+                             'prodigal calls and throughput in gene_caller_benchmark.tsv, then exit')
+    parser.add_argument('--output_format', choices=['tsv', 'parquet'], default='tsv',
+                        help='<--output_format parquet> array2prot_pairs as tsv with list reprs (default) or as parquet '
+                             'with native list columns (array2prot_pairs.parquet, read directly by 03_pairs_to_fasta.py)')
+    parser.add_argument('--single_csv', choices=['full', 'pairs', 'none'], required=False, default='full',
+                        help='<--single_csv full> Per-genome single_csv_and_faa/*.csv: full (all columns, incl. the '
+                             'window and masked window sequences), pairs (the array2prot_pairs.csv columns) or none, '
+                             'default=full')
+    parser.add_argument('--split_bytes', type=parse_size, required=False, default=None,
+                        help='<--split_bytes 100M> Split plain/bgzip genomes of at least this size into tasks of '
+                             '--arrays_per_task arrays that run on several workers at once, default=no splitting')
+    parser.add_argument('--arrays_per_task', type=int, required=False, default=8,
+                        help='<--arrays_per_task 8> Arrays per task of a split genome, default=8')
+    parser.add_argument('--index_dir', type=str, required=False, default=None,
+                        help='<--index_dir /data/fasta_index> Where faidx (.fai/.gzi) indexes of genomes without a '
+                             'fresh samtools index next to them are built and reused, default=outdir/fasta_index')
     parser.add_argument('-o', '--outdir', type=str, required=True,
                         help='<-o /test/output> A path to save output data. e.g., ./output')
     args = parser.parse_args()
 
     minced_to_fna = args.input
-    df_minced2fna = pd.read_csv(minced_to_fna, sep='\t')
-    window = args.window
+    window = args.window[-1]
+    sweep = args.window if len(args.window) > 1 else None
     faa_path = f'{args.outdir}/prodigal_faa/'
     single_csv_faa = f'{args.outdir}/single_csv_and_faa/'
     array2prot_pairs_path = f'{args.outdir}/'
     error_log_path = f'{args.outdir}/error_log.txt'
+    index_dir = args.index_dir or f'{args.outdir}/fasta_index'
     paths = [faa_path, single_csv_faa, array2prot_pairs_path]
     ensure_paths(paths)
 
-    batch_size = 10000
-    with open(f'{array2prot_pairs_path}/array2prot_pairs.csv', 'w') as f, open(error_log_path, 'w') as error_log:
-        f.write('faa_file_name\tcds_region\trepeat_region\tcds_list\tcds2rep_dist\tnum_th_orf\trepeat_number'
-                '\trpt_unit_seq\trepeat_start_end\n')
+    if args.gene_caller_benchmark:
+        compared = gene_caller_benchmark(pd.read_csv(minced_to_fna, sep='\t'), window, index_dir, faa_path,
+                                         args.outdir)
+        sys.exit(0 if compared else 1)
+
+    compute, copies = None, {}
+    if args.dedup is not None:
+        digest_tsv = args.dedup or f'{os.path.dirname(os.path.abspath(minced_to_fna))}/scaffold_digests.tsv'
+        compute, copies = plan_dedup(pd.read_csv(minced_to_fna, sep='\t'), digest_tsv)
+        print(f'dedup: {sum(len(v) for v in compute.values())} distinct arrays to compute, '
+              f'{sum(len(names) for genome in copies.values() for names in genome.values())} copied')
+
+    memory = MemoryBudget(args.mem_budget, 200 << 20, args.mem_factor)
+    split = None
+    if args.split_bytes:
+        split = functools.partial(split_genome, split_bytes=args.split_bytes, arrays_per_task=args.arrays_per_task,
+                                  window=window, merge=args.merge_windows, index_dir=index_dir)
+    tasks = genome_tasks(minced_to_fna, compute, split)
+    task = next(tasks, None)
+    in_flight = {}
+    pair_names = {w: f'{array2prot_pairs_path}/array2prot_pairs{"" if sweep is None else f"_w{w}"}'
+                  for w in sweep or [window]}
+    schema = None
+    if args.output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq  # optional, only needed for --output_format parquet
+        schema = pairs_schema(sweep)
+        pair_files = {w: pq.ParquetWriter(f'{name}.parquet', schema) for w, name in pair_names.items()}
+        buffered = {w: [] for w in pair_names}  # arrow tables per window, written as row groups of ~50k arrays
+    else:
+        pair_files = {w: open(f'{name}.csv', 'w') for w, name in pair_names.items()}
+        for f in pair_files.values():
+            f.write('\t'.join(PAIR_HEADER) + ('\tedge_truncated\n' if sweep else '\n'))
+    with open(error_log_path, 'w') as error_log:
         with ProcessPoolExecutor(max_workers=args.num_threads) as executor:
-            for i in range(0, len(df_minced2fna), batch_size):
-                batch = df_minced2fna.iloc[i:i + batch_size]
-                futures = [
-                    executor.submit(
-                        x, row['file_path'], row['fna_path'], faa_path, single_csv_faa, window
-                    ) for _, row in batch.iterrows()
-                ]
-                for future in as_completed(futures):
+            while task is not None or in_flight:
+                # every worker holds a whole genome, so admit genomes against the memory budget; at most
+                # 2 x num_threads genomes are in flight, so the parent stays flat however long the genome list is
+                while task is not None and len(in_flight) < 2 * args.num_threads:
+                    minced_path, fna_path, arrays, part = task
+                    # indexed (plain/bgzip) genomes only hold their windows, gzip/zstd ones their array scaffolds
+                    parsed = os.path.exists(fna_path) and fasta_io.compression(fna_path) not in (None, 'bgzip')
+                    cost = memory.estimate(fasta_io.uncompressed_size(fna_path) if parsed else 0)
+                    if not memory.try_admit(cost):
+                        break
+                    future = executor.submit(pairs_worker, minced_path, fna_path, faa_path, single_csv_faa, window,
+                                             arrays, index_dir, args.merge_windows, args.gene_caller, sweep,
+                                             copies.get(fna_path), args.output_format, schema, part, args.single_csv)
+                    in_flight[future] = (cost, fna_path)
+                    task = next(tasks, None)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cost, fna_path = in_flight.pop(future)
+                    memory.release(cost)
                     result = future.result()
                     if isinstance(result, tuple) and isinstance(result[1], Exception):  # Check if result is an error
                         fna_path, error = result
                         error_log.write(f"Error in file {fna_path}: {error}\n")  # Write error and file path to log
                     elif result is not None:
                         try:
-                            result.to_csv(f, header=False, index=False, sep='\t')
+                            for w, rows in result.items():
+                                if args.output_format == 'tsv':
+                                    pair_files[w].write(rows)
+                                    continue
+                                buffered[w].append(pa.ipc.open_stream(rows).read_all())
+                                if sum(table.num_rows for table in buffered[w]) >= 50000:
+                                    pair_files[w].write_table(pa.concat_tables(buffered[w]))
+                                    buffered[w] = []
                         except Exception as e:
                             error_log.write(f"Error while saving data: {e}\n")
-    f.close()
-    error_log.close()
+        if args.output_format == 'parquet':
+            for w, tables in buffered.items():
+                if tables:
+                    pair_files[w].write_table(pa.concat_tables(tables))
+    for f in pair_files.values():
+        f.close()
+    print(memory.report())
     finish = time.perf_counter()
     print(f'finished in {round(finish - start, 3)} seconds')
 
@@ -1,10 +1,33 @@
-import os.path, sys
+import os.path, sys, contextlib
 import pandas as pd
-import time, subprocess, ast
+import time, ast, hashlib
+import orf_kernels
+import numpy as np
+from digest_set import DigestSet
+
+
+def as_list(value):
+    # list columns: native lists from array2prot_pairs.parquet, list reprs from the tsv
+    return ast.literal_eval(value) if isinstance(value, str) else list(value)
+
+
+def read_pairs(pairs_file, chunk_rows=100000):
+    # array2prot_pairs in chunks of chunk_rows rows (parquet: record batches), never the whole table
+    if str(pairs_file).endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq  # optional, only needed for parquet input
+        for batch in pq.ParquetFile(pairs_file).iter_batches(batch_size=chunk_rows):
+            table = pa.Table.from_batches([batch])
+            df = table.drop(['cds_list', 'cds2rep_dist', 'num_th_orf']).to_pandas()
+            for column in ['cds_list', 'cds2rep_dist', 'num_th_orf']:
+                df[column] = table.column(column).to_pylist()
+            yield df
+        return
+    yield from pd.read_csv(pairs_file, sep='\t', chunksize=chunk_rows)
 
 
 def prot_fasta(column):
-    prot = ast.literal_eval(column['cds_list'])
+    prot = column['prot_list']
     if len(prot) > 0:
         prot_id_prefix = column['faa_file_name']
         prot_fasta_list = ([f">{prot_id_prefix}_#{n}\n{seq.replace('*', '')}" for n, seq in enumerate(prot) if seq])
@@ -12,32 +35,149 @@ def prot_fasta(column):
         return prot_fasta_list, prot
 
 
-def pairs_to_fasta(pairs_file,repeat_number=3, repeat_len=20):
-    df = pd.read_csv(pairs_file, sep='\t')
-    df_pairs = df.loc[df['cds_list'] != '[]']
-    df_pairs = df_pairs.dropna(subset=['cds_list'])
-    df_pairs['array_fasta'] = df_pairs.apply(
-        lambda row: f">{row['faa_file_name']}\n{row['repeat_region']}", axis=1
-    )
-    df_pairs.drop_duplicates(['repeat_region'], keep='first', inplace=True)
+class UniqueFasta:
+    # inline `seqkit rmdup -n` of the array fasta: one record per array (name + repeat sequence, kept as digests), and
+    # <unique>_counts.tsv with its number of array fasta records (one per kept protein). A name reused with another
+    # sequence (faa_file_name is scaffold__start_end, contig names repeat across MAG assemblies) is a different array:
+    # it is kept and counted as a collision, not dropped. by='sequence' also writes <unique>_members.tsv: every array
+    # dropped as a repeat_region duplicate (add_members) under the representative array with that sequence
+    def __init__(self, fasta_path, by='id'):
+        self.fasta_path = fasta_path
+        self.names, self.arrays = DigestSet(), DigestSet()
+        self.collisions = 0
+        self.fasta = open(fasta_path, 'w')
+        self.counts = open(fasta_path.replace('.csv', '_counts.tsv'), 'w')
+        self.counts.write('array\trecords\n')
+        self.representatives = self.members = None
+        if by == 'sequence':
+            self.representatives = {}  # repeat sequence digest -> array name
+            self.members = open(fasta_path.replace('.csv', '_members.tsv'), 'w')
+            self.members.write('representative\tmember\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fasta.close()
+        self.counts.close()
+        if self.members is not None:
+            self.members.close()
+        if self.collisions:
+            print(f'{self.fasta_path}: {self.collisions} array names reused with another repeat sequence, kept')
+
+    def write(self, names, sequences):
+        # the records of an array are consecutive (one exploded input row), and in a single chunk
+        arrays = []  # [name, sequence, records]
+        for name, sequence in zip(names, sequences):
+            if arrays and arrays[-1][0] == name and arrays[-1][1] == sequence:
+                arrays[-1][2] += 1
+            else:
+                arrays.append([name, sequence, 1])
+        if not arrays:
+            return
+        new_names = self.names.first_seen([name for name, _, _ in arrays])
+        new_arrays = self.arrays.first_seen([f'{name}\t{sequence}' for name, sequence, _ in arrays])
+        self.collisions += int((new_arrays & ~new_names).sum())
+        self.fasta.write(''.join(f'>{name}\n{sequence}\n' for (name, sequence, _), new in zip(arrays, new_arrays)
+                                 if new))
+        self.counts.write(''.join(f'{name}\t{n}\n' for name, _, n in arrays))
+        if self.representatives is not None:
+            for (name, sequence, _), new in zip(arrays, new_arrays):
+                if new:
+                    self.representatives.setdefault(hashlib.blake2b(sequence.encode(), digest_size=16).digest(), name)
+
+    def add_members(self, duplicate_arrays):
+        # (name, repeat_region) of arrays dropped as repeat_region duplicates; those whose representative is in this
+        # fasta are written to the members table
+        if self.representatives is None:
+            return
+        rows = []
+        for name, sequence in duplicate_arrays:
+            representative = self.representatives.get(hashlib.blake2b(sequence.encode(), digest_size=16).digest())
+            if representative is not None:
+                rows.append(f'{representative}\t{name}\n')
+        self.members.write(''.join(rows))
+
+
+class UniqueProteins:
+    # --unique_prot: every distinct protein sequence once, named by its content (prot_<blake2b of the sequence>, the same
+    # ID in every file and run), and <fasta>_members.tsv listing all faa_file_name_#n proteins of each ID
+    def __init__(self, fasta_path):
+        self.seen = DigestSet()
+        self.fasta = open(fasta_path, 'w')
+        self.members = open(fasta_path.replace('.csv', '_members.tsv'), 'w')
+        self.members.write('prot_id\tmember\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fasta.close()
+        self.members.close()
+
+    def write(self, prot_fasta_records):
+        records = [record.split('\n', 1) for record in prot_fasta_records if isinstance(record, str)]
+        sequence_digests = [hashlib.blake2b(sequence.encode(), digest_size=16).digest() for _, sequence in records]
+        first_seen = self.seen.first_seen_digests(np.array(sequence_digests, dtype='S16'))
+        self.fasta.write(''.join(f'>prot_{digest.hex()}\n{sequence}\n' for (_, sequence), digest, first in
+                                 zip(records, sequence_digests, first_seen) if first))
+        self.members.write(''.join(f'prot_{digest.hex()}\t{header[1:]}\n' for (header, _), digest in
+                                   zip(records, sequence_digests)))
 
-    df_pairs = df_pairs[(df_pairs['rpt_unit_seq'].str.len() <= repeat_len) &
-                        (df_pairs['repeat_number'] >= repeat_number)
-                        ]
 
-    df_pairs['prot_fasta'] = df_pairs.apply(lambda column: prot_fasta(column)[0], axis=1)
-    df_pairs['prot_list'] = df_pairs.apply(lambda column: prot_fasta(column)[1], axis=1)
-    df_pairs['cds2rep_dist'] = df_pairs['cds2rep_dist'].apply(ast.literal_eval)
-    df_pairs['num_th_orf'] = df_pairs['num_th_orf'].apply(ast.literal_eval)
+class ProteinFasta:
+    # the prot_fasta_*.csv lines as they are, the default
+    def __init__(self, fasta_path):
+        self.fasta = open(fasta_path, 'w')
 
-    df_pairs_explored = df_pairs.explode(['prot_fasta', 'prot_list', 'cds2rep_dist', 'num_th_orf'])
-    df_pairs_explored.reset_index(drop=True, inplace=True)
+    def __enter__(self):
+        return self
 
-    # dedup on concatenated array_prot_concat
-    df_pairs_explored['array_prot_concat'] = df_pairs_explored['repeat_region'] + df_pairs_explored['prot_list']
-    df_pairs_explored.drop_duplicates(['array_prot_concat'], keep='first', inplace=True)
+    def __exit__(self, *exc):
+        self.fasta.close()
 
-    return df_pairs_explored
+    def write(self, prot_fasta_records):
+        self.fasta.write(''.join(f'{prot_fasta}\n' for prot_fasta in prot_fasta_records))
+
+
+def pairs_to_fasta_chunks(pairs_file, repeat_number=3, repeat_len=20, chunk_rows=100000, duplicate_arrays=None):
+    # pairs_to_fasta() chunk by chunk: the exploded rows of every chunk of the input, the two dedup steps stay global
+    # (keep first over the whole input) through sets of digests of the already seen repeat_region/array_prot_concat.
+    # (faa_file_name, repeat_region) of the arrays dropped as repeat_region duplicates go to duplicate_arrays (a list)
+    seen_arrays, seen_pairs = DigestSet(), DigestSet()
+    for df in read_pairs(pairs_file, chunk_rows):
+        df = df.dropna(subset=['cds_list'])
+        df_pairs = df.loc[df['cds_list'].map(lambda cds_list: cds_list != '[]' and len(cds_list) > 0)]
+        first_seen = seen_arrays.first_seen(df_pairs['repeat_region'])
+        if duplicate_arrays is not None:
+            duplicate_arrays.extend(zip(df_pairs['faa_file_name'][~first_seen], df_pairs['repeat_region'][~first_seen]))
+        df_pairs = df_pairs[first_seen]
+
+        df_pairs = df_pairs[(df_pairs['rpt_unit_seq'].str.len() <= repeat_len) &
+                            (df_pairs['repeat_number'] >= repeat_number)
+                            ].copy()
+        if df_pairs.empty:
+            continue
+        df_pairs['array_fasta'] = df_pairs.apply(
+            lambda row: f">{row['faa_file_name']}\n{row['repeat_region']}", axis=1
+        )
+
+        # list columns are parsed once, and only for the arrays that passed the filters
+        df_pairs['prot_list'] = df_pairs['cds_list'].map(as_list)
+        df_pairs['prot_fasta'] = df_pairs.apply(lambda column: prot_fasta(column)[0], axis=1)
+        df_pairs['cds2rep_dist'] = df_pairs['cds2rep_dist'].map(as_list)
+        df_pairs['num_th_orf'] = df_pairs['num_th_orf'].map(as_list)
+
+        df_pairs_explored = df_pairs.explode(['prot_fasta', 'prot_list', 'cds2rep_dist', 'num_th_orf'])
+        df_pairs_explored.reset_index(drop=True, inplace=True)
+
+        # dedup on concatenated array_prot_concat
+        df_pairs_explored['array_prot_concat'] = df_pairs_explored['repeat_region'] + df_pairs_explored['prot_list']
+        yield df_pairs_explored[seen_pairs.first_seen(df_pairs_explored['array_prot_concat'])]
+
+
+def pairs_to_fasta(pairs_file,repeat_number=3, repeat_len=20):
+    return pd.concat(list(pairs_to_fasta_chunks(pairs_file, repeat_number, repeat_len)), ignore_index=True)
 
 
 if __name__ == '__main__':
@@ -54,14 +194,24 @@ if __name__ == '__main__':
             if not (1 <= args.orf_num <= 50):
                 print("Error: --orf_num must be between 1 and 50 when --mode is 'orf'")
                 sys.exit(1)
+        if args.mode is None and not args.bp and not args.orf:
+            print("Error: give -mode, --bp or --orf")
+            sys.exit(1)
+        if not all(1000 <= bp <= 20000 for bp in args.bp):
+            print("Error: --bp values must be between 1000 and 20000")
+            sys.exit(1)
+        if not all(1 <= orf <= 50 for orf in args.orf):
+            print("Error: --orf values must be between 1 and 50")
+            sys.exit(1)
 
 
     parser = argparse.ArgumentParser(description='Extract array and protein fasta and deduplicate on array-protein '
                                                  'concatenation')
-    parser.add_argument('-i', '--input', type=argparse.FileType('r'), required=True,
-                        help='<-i array2prot_pairs.csv> The array2prot_pairs.csv obtained from 02_ap_pairs_v2.py')
-    parser.add_argument('-mode', choices=['bp', 'orf'], required=True,
-                        help="Specify the mode of operation: 'bp' or 'orf'")
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help='<-i array2prot_pairs.csv> The array2prot_pairs.csv (or array2prot_pairs.parquet) obtained '
+                             'from 02_ap_pairs_v2.py')
+    parser.add_argument('-mode', choices=['bp', 'orf'], required=False,
+                        help="Specify the mode of operation: 'bp' or 'orf' (required unless --bp/--orf are given)")
     parser.add_argument('-rN', '--repeat_number', type=int, default=3, required=False,
                         help='<-rN 3> Lower limit of repeat number, default=3')
     parser.add_argument('-rL', '--repeat_length', type=int, default=20, required=False,
@@ -70,8 +220,26 @@ if __name__ == '__main__':
                         help='<-bp_num 8000> Range [1000, 20000], default=8000, fetch orfs on distance')
     parser.add_argument('-orf_num', '--orf_num', type=int, default=5, required=False,
                         help='<-orf_num 5> Range [1, 50], default=5, fetch orf_num orfs up-/downstream of array')
+    parser.add_argument('--bp', type=lambda text: sorted({int(bp) for bp in text.split(',')}), default=[],
+                        required=False,
+                        help='<--bp 2000,5000,8000> bp mode filtered fasta for each of these distances, in one pass '
+                             '(with -mode bp, -bp_num is added to them)')
+    parser.add_argument('--orf', type=lambda text: sorted({int(orf) for orf in text.split(',')}), default=[],
+                        required=False,
+                        help='<--orf 3,5,10> orf mode filtered fasta for each of these orf numbers, in one pass '
+                             '(with -mode orf, -orf_num is added to them)')
     parser.add_argument('-o', '--outdir', type=str, required=True,
                         help='<-o /test/output> A path to save output data. e.g., ./output')
+    parser.add_argument('--dedup_by', choices=['id', 'sequence'], default='id', required=False,
+                        help='<--dedup_by sequence> id (default): *_unique.csv array fasta with one record per '
+                             'array; sequence: also *_unique_members.tsv listing, per representative array, the arrays '
+                             'dropped for carrying the same repeat region')
+    parser.add_argument('--unique_prot', action='store_true', required=False, default=False,
+                        help='<--unique_prot> Write each distinct protein sequence once per prot_fasta file, named '
+                             'prot_<sequence digest>, with prot_fasta_*_members.tsv mapping these IDs to the original '
+                             'faa_file_name_#n proteins (for 04 --prot_members and 05 --prot_members)')
+    parser.add_argument('--chunk_rows', type=int, default=100000, required=False,
+                        help='<--chunk_rows 100000> Input rows read, filtered and written at a time, default=100000')
     args = parser.parse_args()
     validate_arguments(args)
 
@@ -80,43 +248,55 @@ if __name__ == '__main__':
     if not os.path.exists(fasta_dir):
         os.makedirs(fasta_dir)
 
-    df_pairs_final = pairs_to_fasta(pairs_file,args.repeat_number,args.repeat_length)
+    # filtered sets: -mode with -bp_num/-orf_num, plus every --bp/--orf threshold (sorted, so they are nested)
+    thresholds = {'bp': args.bp, 'orf': args.orf}
+    if args.mode == 'bp':
+        thresholds['bp'] = sorted(set(args.bp) | {args.base_pair_num})
+    if args.mode == 'orf':
+        thresholds['orf'] = sorted(set(args.orf) | {args.orf_num})
+    columns = {'bp': 'cds2rep_dist', 'orf': 'num_th_orf'}
 
-    # print(df_pairs_final)
-    # df_pairs_final['array_prot_concat'].to_csv(f'{fasta_dir}/array_prot_concat.csv', sep='\t', index=False)
-    with open(f'{fasta_dir}/array_fasta_all.csv', 'w') as f_array, open(f'{fasta_dir}/prot_fasta_all.csv', 'w') as f_prot:
-        for _, row in df_pairs_final.iterrows():
-            f_array.write(f"{row['array_fasta']}\n")
-            f_prot.write(f"{row['prot_fasta']}\n")
-    f_prot.close()
-    f_array.close()
+    # fasta lines are written chunk by chunk, all pairs and those passing each filter; the *_unique.csv array fasta
+    # (with *_unique_counts.tsv, --dedup_by sequence: *_unique_members.tsv) are deduplicated while writing
+    with contextlib.ExitStack() as stack:
+        f_array = stack.enter_context(open(f'{fasta_dir}/array_fasta_all.csv', 'w'))
+        protein_writer = UniqueProteins if args.unique_prot else ProteinFasta
+        f_prot = stack.enter_context(protein_writer(f'{fasta_dir}/prot_fasta_all.csv'))
+        unique_array = stack.enter_context(UniqueFasta(f'{fasta_dir}/array_fasta_unique.csv', args.dedup_by))
+        filtered = {}  # input_type -> [(f_filtered_array, f_filtered_prot, unique_filtered_array)] per threshold
+        for input_type, values in thresholds.items():
+            filtered[input_type] = []
+            for value in values:
+                filtered_array = f'{fasta_dir}/array_fasta_filter_by_{value}_{input_type}.csv'
+                filtered_prot = f'{fasta_dir}/prot_fasta_filter_by_{value}_{input_type}.csv'
+                filtered[input_type].append((
+                    stack.enter_context(open(filtered_array, 'w')), stack.enter_context(protein_writer(filtered_prot)),
+                    stack.enter_context(UniqueFasta(filtered_array.replace('.csv', '_unique.csv'), args.dedup_by))))
 
-    input_type, value = '', ''
-    if args.mode == 'orf':
-        df_pairs_final = df_pairs_final[df_pairs_final['num_th_orf'] <= args.orf_num]
-        input_type = 'orf'
-        value = args.orf_num
-    if args.mode == 'bp':
-        df_pairs_final = df_pairs_final[df_pairs_final['cds2rep_dist'] <= args.base_pair_num]
-        input_type = 'bp'
-        value = args.base_pair_num
-
-    filtered_array = f'{fasta_dir}/array_fasta_filter_by_{value}_{input_type}.csv'
-    filtered_prot = f'{fasta_dir}/prot_fasta_filter_by_{value}_{input_type}.csv'
-    with open(filtered_array, 'w') as f_array, open(filtered_prot, 'w') as f_prot:
-        for _, row in df_pairs_final.iterrows():
-            f_array.write(f"{row['array_fasta']}\n")
-            f_prot.write(f"{row['prot_fasta']}\n")
-    f_prot.close()
-    f_array.close()
-
-    seqkit = ['seqkit', 'rmdup', '-w', '0', '-n', f'{fasta_dir}/array_fasta_all.csv', '-o',
-              f'{fasta_dir}/array_fasta_unique.csv']
-    subprocess.run(seqkit)
-
-    seqkit = ['seqkit', 'rmdup', '-w', '0', '-n', f'{filtered_array}', '-o',
-              f'{filtered_array.replace(".csv", "_unique.csv")}']
-    subprocess.run(seqkit)
+        unique_arrays = [unique_array] + [unique for outputs in filtered.values() for _, _, unique in outputs]
+        duplicate_arrays = [] if args.dedup_by == 'sequence' else None
+        for df_pairs_final in pairs_to_fasta_chunks(pairs_file, args.repeat_number, args.repeat_length,
+                                                    args.chunk_rows, duplicate_arrays):
+            f_array.write(''.join(f'{array_fasta}\n' for array_fasta in df_pairs_final['array_fasta']))
+            f_prot.write(df_pairs_final['prot_fasta'])
+            unique_array.write(df_pairs_final['faa_file_name'], df_pairs_final['repeat_region'])
+
+            for input_type, outputs in filtered.items():
+                # a CDS at level k passes thresholds k, k+1, ...
+                levels = orf_kernels.threshold_levels(df_pairs_final[columns[input_type]], thresholds[input_type])
+                for level, (f_filtered_array, f_filtered_prot, unique_filtered_array) in enumerate(outputs):
+                    df_filtered = df_pairs_final[levels <= level]
+                    f_filtered_array.write(''.join(f'{array_fasta}\n' for array_fasta in df_filtered['array_fasta']))
+                    f_filtered_prot.write(df_filtered['prot_fasta'])
+                    unique_filtered_array.write(df_filtered['faa_file_name'], df_filtered['repeat_region'])
+            if duplicate_arrays:
+                # representatives come first in the input, so they are written by now
+                for unique in unique_arrays:
+                    unique.add_members(duplicate_arrays)
+                duplicate_arrays.clear()
+        if duplicate_arrays:  # from trailing chunks without new arrays
+            for unique in unique_arrays:
+                unique.add_members(duplicate_arrays)
 
     finish = time.perf_counter()
 
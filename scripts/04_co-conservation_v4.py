@@ -6,7 +6,20 @@ from itertools import product
 from collections import Counter
 
 
-def tsv2network(tsv_file, mini_node):
+def read_members(members_tsv):
+    # 03 --unique_prot sidecar: content protein ID -> all faa_file_name_#n proteins with its sequence
+    df_members = pd.read_csv(members_tsv, sep='\t')
+    return df_members.groupby('prot_id')['member'].agg(list).to_dict()
+
+
+def expand(nodes, members=None):
+    # the faa_file_name_#n proteins behind graph nodes (the nodes themselves without --prot_members)
+    if members is None:
+        return list(nodes)
+    return [member for node in nodes for member in members.get(node, [node])]
+
+
+def tsv2network(tsv_file, mini_node, members=None):
     print(f'building {tsv_file} network')
     G = nx.Graph()
 
@@ -18,7 +31,7 @@ def tsv2network(tsv_file, mini_node):
     print(f'found {len(list(connected_components(G)))} clusters in {tsv_file}')
 
     # to_be_removed
-    remove_node = [node for cc in connected_components(G) if len(cc) < mini_node for node in cc]
+    remove_node = [node for cc in connected_components(G) if len(expand(cc, members)) < mini_node for node in cc]
     print(f'removed {len(remove_node)} nodes')
     G.remove_nodes_from(remove_node)
     G.remove_edges_from(nx.selfloop_edges(G))  # remove self-connected nodes
@@ -51,13 +64,14 @@ def process_df_chunk(chunk_info):  # chunk_infor = [chunk, coverage,array_net,pr
     cov = chunk_info[1]
     # array_net = chunk_info[2]
     # prot_net = chunk_info[3]
-    df_chunk[['processed_prot', 'processed_prot_dict']] = df_chunk.apply(lambda row: process_node(row['prot']),
+    # prot_members: the faa_file_name_#n proteins of the cluster (its nodes, or their --prot_members)
+    df_chunk[['processed_prot', 'processed_prot_dict']] = df_chunk.apply(lambda row: process_node(row['prot_members']),
                                                                          axis=1,
                                                                          result_type='expand'
                                                                          )
     df_chunk['intersection'] = df_chunk.apply(lambda row: get_intersection(row['array'], row['processed_prot']), axis=1)
     df_chunk['cov'] = df_chunk.apply(
-        lambda row: cal_coverage(row['intersection'], row['processed_prot_dict'], row['prot']), axis=1)
+        lambda row: cal_coverage(row['intersection'], row['processed_prot_dict'], row['prot_members']), axis=1)
 
     # only get remaining prot ids
     df_remained = df_chunk[df_chunk['cov'] >= cov]
@@ -69,16 +83,36 @@ def process_df_chunk(chunk_info):  # chunk_infor = [chunk, coverage,array_net,pr
     return keep_prot_ids, keep_array_ids   # manuscript_v2 using keep_array_ids
 
 
-def conserved_cluster(array_net, prot_net, coverage,num_cores):
-    G_array_updated = nx.Graph()
-    G_prot_updated = nx.Graph()
-
+def indexed_keep_prot_ids(array_net, prot_net, coverage, members=None):
+    # --engine index: every array ID points to its array cluster, so each protein cluster only counts its hits per
+    # array cluster (a sparse cluster x cluster incidence product); pairs without a shared array have cov 0 and are
+    # never built. Same coverage as process_df_chunk/cal_coverage, cost ~ cluster membership
+    array_cluster_of = {}
+    n_array_clusters = 0
+    for n_array_clusters, array_cc in enumerate(connected_components(array_net), start=1):
+        for array_id in array_cc:
+            array_cluster_of[array_id] = n_array_clusters
+
+    keep_prot_ids = set()
+    for prot_cc in connected_components(prot_net):
+        prot_members = expand(prot_cc, members)
+        hits = Counter(array_cluster_of.get(re.sub(r'_#\d+', '', prot_id)) for prot_id in prot_members)
+        hits.pop(None, None)
+        if (coverage <= 0 and n_array_clusters) or \
+                any(round(count / len(prot_members), 2) >= coverage for count in hits.values()):
+            keep_prot_ids.update(prot_cc)
+    return keep_prot_ids
+
+
+def product_keep_prot_ids(array_net, prot_net, coverage, num_cores, members=None):
+    # --engine product: every array cluster x protein cluster pair is evaluated
     array_cluster = connected_components(array_net)
-    prot_cluster = connected_components(prot_net)
+    prot_cluster = [(cc, expand(cc, members)) for cc in connected_components(prot_net)]
 
     # version 4, only get remained protein ids  meta: 393 seconds/ NCBI: 18483 seconds
-    array_prot_comb = product(list(array_cluster), list(prot_cluster))  # comb[0] = array, comb[1] = prot
-    df_comb = pd.DataFrame(list(array_prot_comb), columns=['array', 'prot'])
+    array_prot_comb = product(list(array_cluster), prot_cluster)  # comb[0] = array, comb[1] = (prot, prot_members)
+    df_comb = pd.DataFrame([(array, prot, prot_members) for array, (prot, prot_members) in array_prot_comb],
+                           columns=['array', 'prot', 'prot_members'])
 
     print(f'analyzing co-conservation on {num_cores} cores. most time-consuming step')
     chunk_size = 200000 if len(df_comb.index) > 200000 else len(df_comb.index)
@@ -99,6 +133,17 @@ def conserved_cluster(array_net, prot_net, coverage,num_cores):
 
     keep_prot_ids = set().union(*results_prot)
     keep_array_ids = set().union(*results_array)  # manuscript_v2 using keep_array_ids
+    return keep_prot_ids
+
+
+def conserved_cluster(array_net, prot_net, coverage,num_cores, members=None, engine='index'):
+    G_array_updated = nx.Graph()
+    G_prot_updated = nx.Graph()
+
+    if engine == 'index':
+        keep_prot_ids = indexed_keep_prot_ids(array_net, prot_net, coverage, members)
+    else:
+        keep_prot_ids = product_keep_prot_ids(array_net, prot_net, coverage, num_cores, members)
 
     keep_edges = list(prot_net.edges(keep_prot_ids))
     G_prot_updated.add_nodes_from(keep_prot_ids)
@@ -133,6 +178,13 @@ if __name__ == '__main__':
                         help='<-n 5> Number of threads (default n = all cpus), all threads  will be used if not given')
     parser.add_argument('-o', '--outdir', type=str, required=True,
                         help='<-o ./output> A path to save output data. e.g., ./output')
+    parser.add_argument('--engine', choices=['index', 'product'], required=False, default='index',
+                        help='<--engine index> index: count each protein cluster\'s hits per array cluster through an '
+                             'array ID index (cost ~ cluster sizes); product: evaluate every array x protein cluster '
+                             'pair on -n threads (the v4 engine), default=index')
+    parser.add_argument('--prot_members', type=str, required=False, default=None,
+                        help='<--prot_members prot_fasta_filter_by_5_orf_members.tsv> With -p clustered from 03 '
+                             '--unique_prot fasta: the ID mapping, so every content ID counts as all its proteins')
     args = parser.parse_args()
 
     array_tsv = args.array_cluster
@@ -145,15 +197,18 @@ if __name__ == '__main__':
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    members = read_members(args.prot_members) if args.prot_members else None
+
     df_prot_id = pd.read_csv(prot_tsv, sep='\t', header=None)
-    all_prot = len(df_prot_id.iloc[:, 1].index)
+    all_prot = len(expand(df_prot_id.iloc[:, 1], members))
     all_central_prot = set(df_prot_id.iloc[:, 0])
     del df_prot_id
 
-    prot_net = tsv2network(prot_tsv, mininode)
+    prot_net = tsv2network(prot_tsv, mininode, members)
     array_net = tsv2network(array_tsv, mininode)
 
-    G_prot_updated, removed_nodes, keep_prot_ids = conserved_cluster(array_net, prot_net, coverage, num_cores)
+    G_prot_updated, removed_nodes, keep_prot_ids = conserved_cluster(array_net, prot_net, coverage, num_cores,
+                                                                     members, args.engine)
 
     # Function to get the next version number for a given file pattern
     def get_next_version(outdir, filename_prefix, file_extension):
@@ -188,8 +243,9 @@ if __name__ == '__main__':
     df_kept_nodes = pd.DataFrame(list(keep_prot_ids), columns=[f'remained_nodes'])
     df_kept_nodes.to_csv(f'{outdir}/v{kept_nodes_version}_prot_kept.csv', index=False)
 
-    df_kept_nodes.iloc[:, 0] = df_kept_nodes.iloc[:, 0].str.replace(r'_#\d+', '', regex=True)
-    df_kept_array = df_kept_nodes.drop_duplicates(subset=['remained_nodes'], keep='first')
+    df_kept_array = pd.DataFrame(expand(keep_prot_ids, members), columns=[f'remained_nodes'])
+    df_kept_array.iloc[:, 0] = df_kept_array.iloc[:, 0].str.replace(r'_#\d+', '', regex=True)
+    df_kept_array = df_kept_array.drop_duplicates(subset=['remained_nodes'], keep='first')
     df_kept_array.to_csv(f'{outdir}/v{kept_array_version}_array_kept.csv', index=False)
 
     # get central node/representative from updated graph = 1st column in .stv - removed nodes
@@ -203,17 +259,17 @@ if __name__ == '__main__':
         'prot_tsv': prot_tsv,
         'array_tsv': array_tsv,
         'outdir': outdir,
-        'df_kept_nodes': f'{outdir}/prot_kept_{len(keep_prot_ids)}_nodes_c_{coverage}_n_{mininode}.csv',
+        'df_kept_nodes': f'{outdir}/prot_kept_{len(expand(keep_prot_ids, members))}_nodes_c_{coverage}_n_{mininode}.csv',
         'prot_representative_nodes': f'{outdir}/prot_representative_nodes.txt',
         'coverage': coverage,
         'mininode': mininode,
         'protein_cluster_info': '',
         'protein_net_clusters': f'{len(list(connected_components(prot_net)))} clusters',
-        'number_of_protein_filter_on_mininode': len(prot_net),
+        'number_of_protein_filter_on_mininode': len(expand(prot_net, members)),
         'updated protein_net_clusters': f'{len(list(connected_components(G_prot_updated)))} clusters',
-        'removed_protein_number_after_co-conservation': len(removed_nodes),
-        'removed_protein_in_total': all_prot - len(G_prot_updated),
-        'remaining_proteins': len(G_prot_updated),
+        'removed_protein_number_after_co-conservation': len(expand(removed_nodes, members)),
+        'removed_protein_in_total': all_prot - len(expand(G_prot_updated, members)),
+        'remaining_proteins': len(expand(G_prot_updated, members)),
         'remaining_arrays': len(df_kept_array['remained_nodes']),
         'prot_representative_nodes:': len(prot_representative_nodes),
         'total_time_used': f'{round(time.time() - start, 2)} seconds'
@@ -114,10 +114,17 @@ def parse_pfam(pfam_table, table_from, prot_ids_focus_on=None):
 
 
 def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges=None, percent=None,reference_pfam_table=None, pfam_needed=None,
-                  prot_ids_focus_on=None):
+                  prot_ids_focus_on=None, prot_members=None):
     df_pfam_acc = pd.read_table(pfam_acc, sep='\t')
     pfam_acc_dict = df_pfam_acc.groupby(['pfam_accession'])['description'].agg(', '.join).to_dict()
     protein_fasta_fict = SeqIO.to_dict(SeqIO.parse(protein_fasta, 'fasta'))
+    # 03 --unique_prot: a content protein ID counts as all the faa_file_name_#n proteins with its sequence
+    multiplicity = collections.Counter()
+    if prot_members is not None:
+        multiplicity = collections.Counter(pd.read_csv(prot_members, sep='\t')['prot_id'])
+
+    def n_proteins(prot_ids):
+        return sum(multiplicity.get(prot_id, 1) for prot_id in prot_ids)
 
     G = nx.DiGraph()
 
@@ -149,8 +156,9 @@ def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges
     node_attr = {}
     pfam2prot_num = {}
     for pfam_id, df_gy in df_on_pfam:
-        number_of_proteins = len(df_gy['protein_id'].unique())
-        protein_seq_length = [len(protein_fasta_fict[prot_id]) for prot_id in df_gy['protein_id'].to_list()]
+        number_of_proteins = n_proteins(df_gy['protein_id'].unique())
+        protein_seq_length = [len(protein_fasta_fict[prot_id]) for prot_id in df_gy['protein_id'].to_list()
+                              for _ in range(multiplicity.get(prot_id, 1))]
         protein_seq_length.sort()
         seq_len_min = protein_seq_length[0]
         seq_len_max = protein_seq_length[-1]
@@ -181,28 +189,29 @@ def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges
     # add edge attributes: status(known, or New), num_of_prot
     edge_attr = {}
     for pfam_pair, prot_id in pair2id.items():
-        protein_seq_length = [len(protein_fasta_fict[prot_id]) for prot_id in prot_id]
+        protein_seq_length = [len(protein_fasta_fict[prot_id]) for prot_id in prot_id
+                              for _ in range(multiplicity.get(prot_id, 1))]
         protein_seq_length.sort()
         seq_len_min = protein_seq_length[0]
         seq_len_max = protein_seq_length[-1]
-        seq_len_avg = sum(protein_seq_length) / len(prot_id)
+        seq_len_avg = sum(protein_seq_length) / n_proteins(prot_id)
         seq_len_mid = protein_seq_length[int(len(protein_seq_length) / 2)]
         edge = tuple(pfam_pair.split(','))
         # draw edge on count/percentage
-        percentage = round(len(prot_id) / max(pfam2prot_num[edge[0]], pfam2prot_num[edge[1]]), 2)
+        percentage = round(n_proteins(prot_id) / max(pfam2prot_num[edge[0]], pfam2prot_num[edge[1]]), 2)
         include = (edge in ref_pair_tuple or ref_pfam_node.intersection(
             set(edge))) if reference_pfam_table is not None else True
         pfam_atte = set(edge).intersection(set(atte_domain)) if pfam_needed is not None else True
-        if len(prot_id) >= minimal_edges and percentage >= percent:  # or include or pfam_atte
+        if n_proteins(prot_id) >= minimal_edges and percentage >= percent:  # or include or pfam_atte
             edge_attr[edge] = {
                 'pfam_accession': ','.join(list(edge)),
                 # 'annotation': ','.join([pfam_acc_dict[pfam_id] if pfam_id in pfam_acc_dict.keys() else None for pfam_id in edge]),
                 # 'annotation': ','.join([pfam_acc_dict[pfam_id] for pfam_id in edge if pfam_id in pfam_acc_dict]),
                 'annotation': ','.join(
                     [pfam_acc_dict[pfam_id] if pfam_id in pfam_acc_dict else 'Unknown' for pfam_id in edge]),
-                'name': f'C:{len(prot_id)}/P:{percentage}',
+                'name': f'C:{n_proteins(prot_id)}/P:{percentage}',
                 'protein_contain_this_domain_pair': '\n'.join(prot_id),
-                'number_of_proteins': len(prot_id),
+                'number_of_proteins': n_proteins(prot_id),
                 'presence_status': 'New' if edge not in ref_pair_tuple else 'Found',
                 'present_in': '\n'.join(ref_pair2id[pfam_pair]) if edge in ref_pair_tuple else 'Na',
                 'present_in_how_many_ref_Cas': len(ref_pair2id[pfam_pair]) if edge in ref_pair_tuple else 0,
@@ -245,6 +254,9 @@ if __name__ == '__main__':
                         help='<-m 0> Default=0, number of edges in a cluster')
     parser.add_argument('-o', '--outdir', type=str, required=True,
                         help='<-o ./output> A path to save output data. e.g., ./output')
+    parser.add_argument('--prot_members', type=str, required=False, default=None,
+                        help='<--prot_members prot_fasta_filter_by_5_orf_members.tsv> Optional, with -f from 03 '
+                             '--unique_prot: protein counts include every protein sharing a sequence')
     args = parser.parse_args()
 
     # input constant:
@@ -297,7 +309,8 @@ if __name__ == '__main__':
                   percent=percent,
                   reference_pfam_table=known_hmm_table,
                   pfam_needed=pfam_needed,
-                  prot_ids_focus_on=prot_ids_focus_on
+                  prot_ids_focus_on=prot_ids_focus_on,
+                  prot_members=args.prot_members
                   )
     print(f'Total finished in {round(time.time() - start, 2)} seconds\n')
     # print(build_network(pfam_table))
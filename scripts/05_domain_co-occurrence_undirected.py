@@ -76,10 +76,17 @@ def parse_pfam(pfam_table, table_from, prot_ids_focus_on=None):
 
 
 def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges=0, percent=0,
-                  reference_pfam_table=None, pfam_needed=None, prot_ids_focus_on=None):
+                  reference_pfam_table=None, pfam_needed=None, prot_ids_focus_on=None, prot_members=None):
     df_pfam_acc = pd.read_table(pfam_acc, sep='\t')
     pfam_acc_dict = df_pfam_acc.groupby('pfam_accession')['description'].agg(', '.join).to_dict()
     protein_fasta_dict = SeqIO.to_dict(SeqIO.parse(protein_fasta, 'fasta'))
+    # 03 --unique_prot: a content protein ID counts as all the faa_file_name_#n proteins with its sequence
+    multiplicity = collections.Counter()
+    if prot_members is not None:
+        multiplicity = collections.Counter(pd.read_csv(prot_members, sep='\t')['prot_id'])
+
+    def n_proteins(prot_ids):
+        return sum(multiplicity.get(prot_id, 1) for prot_id in prot_ids)
 
     G = nx.Graph()  # Use an undirected graph here
 
@@ -105,7 +112,8 @@ def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges
     pfam2prot_num = {}
     for pfam_id, df_gy in df_on_pfam:
         prot_ids = df_gy['protein_id'].unique()
-        lengths = [len(protein_fasta_dict[p]) for p in prot_ids if p in protein_fasta_dict]
+        lengths = [len(protein_fasta_dict[p]) for p in prot_ids if p in protein_fasta_dict
+                   for _ in range(multiplicity.get(p, 1))]
         if not lengths:
             continue
         lengths.sort()
@@ -118,16 +126,16 @@ def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges
 
         node_attr[pfam_id] = {
             'pfam_accession': pfam_id,
-            'name': f'{pfam_short_name.get(pfam_id, pfam_id)}\n{len(prot_ids)} proteins\n{stats["min"]}-{stats["max"]}-{stats["avg"]}-{stats["mid"]}',
+            'name': f'{pfam_short_name.get(pfam_id, pfam_id)}\n{n_proteins(prot_ids)} proteins\n{stats["min"]}-{stats["max"]}-{stats["avg"]}-{stats["mid"]}',
             'protein_contain_this_domain': '\n'.join(prot_ids),
-            'number_of_proteins': len(prot_ids),
+            'number_of_proteins': n_proteins(prot_ids),
             'presence_status': 'New' if pfam_id not in ref_pfam_node else 'Found',
             'present_in': '\n'.join(ref_pfam2id.get(pfam_id, [])),
             'present_in_how_many_ref_Cas': len(ref_pfam2id.get(pfam_id, [])),
             'annotation': pfam_acc_dict.get(pfam_id, ''),
             'protein_seq_length': f'min: {stats["min"]}/max: {stats["max"]}/avg: {stats["avg"]}/mid: {stats["mid"]}',
         }
-        pfam2prot_num[pfam_id] = len(prot_ids)
+        pfam2prot_num[pfam_id] = n_proteins(prot_ids)
 
     nx.set_node_attributes(G, node_attr)
 
@@ -142,7 +150,8 @@ def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges
     for pair_str, prot_ids in pair2id.items():
         pfam1, pfam2 = pair_str.split(',')
         edge = tuple(sorted((pfam1, pfam2)))
-        lengths = [len(protein_fasta_dict[p]) for p in prot_ids if p in protein_fasta_dict]
+        lengths = [len(protein_fasta_dict[p]) for p in prot_ids if p in protein_fasta_dict
+                   for _ in range(multiplicity.get(p, 1))]
         if not lengths:
             continue
         lengths.sort()
@@ -153,17 +162,17 @@ def build_network(pfam_table, pfam_acc, protein_fasta, graph_path, minimal_edges
             'mid': lengths[len(lengths) // 2],
         }
 
-        percentage = round(len(prot_ids) / max(pfam2prot_num.get(pfam1, 1), pfam2prot_num.get(pfam2, 1)), 2)
+        percentage = round(n_proteins(prot_ids) / max(pfam2prot_num.get(pfam1, 1), pfam2prot_num.get(pfam2, 1)), 2)
         include = (edge in ref_pair_tuple or ref_pfam_node.intersection(edge)) if reference_pfam_table else True
         atte = set(edge).intersection(atte_domain) if pfam_needed else True
 
-        if len(prot_ids) >= minimal_edges and percentage >= percent:
+        if n_proteins(prot_ids) >= minimal_edges and percentage >= percent:
             edge_attr[edge] = {
                 'pfam_accession': ','.join(edge),
                 'annotation': ','.join([pfam_acc_dict.get(p, '') for p in edge]),
-                'name': f'C:{len(prot_ids)}/P:{percentage}',
+                'name': f'C:{n_proteins(prot_ids)}/P:{percentage}',
                 'protein_contain_this_domain_pair': '\n'.join(prot_ids),
-                'number_of_proteins': len(prot_ids),
+                'number_of_proteins': n_proteins(prot_ids),
                 'presence_status': 'New' if edge not in ref_pair_tuple else 'Found',
                 'present_in': '\n'.join(ref_pair2id.get(','.join(edge), [])),
                 'present_in_how_many_ref_Cas': len(ref_pair2id.get(','.join(edge), [])),
@@ -196,6 +205,9 @@ if __name__ == '__main__':
                         help='Minimal number of proteins per domain-pair')
     parser.add_argument('-o', '--outdir', type=str, required=True,
                         help='<-o ./output>')
+    parser.add_argument('--prot_members', type=str, required=False, default=None,
+                        help='<--prot_members prot_fasta_filter_by_5_orf_members.tsv> Optional, with -f from 03 '
+                             '--unique_prot: protein counts include every protein sharing a sequence')
     args = parser.parse_args()
 
     if not os.path.exists(args.outdir):
@@ -214,7 +226,8 @@ if __name__ == '__main__':
         percent=args.percent,
         reference_pfam_table=args.reference,
         pfam_needed=None,
-        prot_ids_focus_on=args.prot_id_focused
+        prot_ids_focus_on=args.prot_id_focused,
+        prot_members=args.prot_members
     )
     print(f'Total finished in {round(time.time() - start, 2)} seconds\n')
 
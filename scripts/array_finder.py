@@ -0,0 +1,205 @@
+import numpy as np
+
+# In-process CRISPR repeat-array finder (CRT/minced-style search) used by 01_array.py --engine native.
+# Candidate repeat positions are seeded with NumPy on a 2-bit encoded sequence, the seeds are then
+# chained, extended and validated in Python, and arrays are written in the same GFF layout as `minced -gff`.
+
+SEARCH_WINDOW = 8  # exact k-mer length used to seed repeats, same as the CRT/minced default
+PREFILTER_WINDOW = 11  # longer k-mer for the prefilter, 8-mers recur by chance every few kb
+MAX_K = 11  # 2-bit k-mer (22 bits) + position (40 bits) must fit one int64 sort key
+_POS_BITS = 40
+EXTEND_THRESHOLD = 0.75  # a repeat column is kept while >= 75% of the repeats agree on the base
+SPACER_SIMILARITY = 0.62  # spacers too similar to each other or to the repeat are not CRISPR spacers
+
+_BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(b'ACGT'):
+    _BASE_CODE[_b] = _i
+    _BASE_CODE[_b + 32] = _i  # lowercase (soft-masked) bases
+
+
+def read_fasta(handle):
+    # yields (record id, sequence) with the id cut at the first whitespace, as minced and SeqIO do
+    name, chunks = None, []
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('>'):
+            if name is not None:
+                yield name, ''.join(chunks).upper()
+            name, chunks = (line[1:].split() or [''])[0], []
+        else:
+            chunks.append(line)
+    if name is not None:
+        yield name, ''.join(chunks).upper()
+
+
+def encode_2bit(sequence):
+    # A/C/G/T -> 0..3, anything else (N, IUPAC) -> 4
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii', 'replace')
+    return _BASE_CODE[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def kmer_codes(codes, k=SEARCH_WINDOW):
+    # rolling 2-bit hash of every k-mer (k <= MAX_K), k-mers overlapping a non-ACGT base get -1
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    valid = codes < 4
+    c = np.where(valid, codes, 0).astype(np.uint32)
+    kmers = np.zeros(n, dtype=np.uint32)
+    for i in range(k):
+        kmers = (kmers << np.uint32(2)) | c[i:i + n]
+    kmers = kmers.astype(np.int64)
+    invalid_sum = np.concatenate(([0], np.cumsum(~valid)))
+    kmers[(invalid_sum[k:k + n] - invalid_sum[:n]) > 0] = -1
+    return kmers
+
+
+def repeat_partners(kmers, min_gap, max_gap, lookahead=4):
+    # for every position the nearest downstream copy of its k-mer min_gap..max_gap bp away
+    # (one repeat + one spacer), -1 if there is none
+    partners = np.full(len(kmers), -1, dtype=np.int64)
+    valid_idx = np.flatnonzero(kmers >= 0)
+    if len(valid_idx) < 2:
+        return partners
+    # one sort on (k-mer, position) packed into an int64 is much cheaper than a stable argsort
+    keys = np.sort((kmers[valid_idx] << _POS_BITS) | valid_idx)
+    sorted_kmers = keys >> _POS_BITS
+    order = keys & ((1 << _POS_BITS) - 1)
+    for step in range(min(lookahead, len(order) - 1), 0, -1):  # smaller steps overwrite, nearest copy wins
+        gap = order[step:] - order[:-step]
+        ok = (sorted_kmers[step:] == sorted_kmers[:-step]) & (gap >= min_gap) & (gap <= max_gap)
+        partners[order[:-step][ok]] = order[step:][ok]
+    return partners
+
+
+def candidate_seeds(kmers, min_gap, max_gap, lookahead=4):
+    # positions whose k-mer re-occurs one repeat + spacer downstream
+    return np.flatnonzero(repeat_partners(kmers, min_gap, max_gap, lookahead) >= 0)
+
+
+def periodic_repeat_starts(sequence, num_of_repeats, rep_min, rep_max, spa_min, spa_max, k=PREFILTER_WINDOW):
+    # starts of exact k-mers that re-occur num_of_repeats times in a row at CRISPR repeat+spacer spacing
+    k = min(k, rep_min, MAX_K)
+    partners = repeat_partners(kmer_codes(encode_2bit(sequence), k), rep_min + spa_min, rep_max + spa_max)
+    starts = np.flatnonzero(partners >= 0)
+    copies = partners[starts]
+    for _ in range(num_of_repeats - 2):
+        keep = partners[copies] >= 0
+        starts, copies = starts[keep], partners[copies[keep]]
+    return starts
+
+
+def prefilter(sequence, num_of_repeats, rep_min, rep_max, spa_min, spa_max, k=PREFILTER_WINDOW):
+    # cheap go/no-go before the full array caller
+    return len(periodic_repeat_starts(sequence, num_of_repeats, rep_min, rep_max, spa_min, spa_max, k)) > 0
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    same = sum(1 for x, y in zip(a, b) if x == y)
+    return same / max(len(a), len(b))
+
+
+def _repeat_chain(sequence, pos, k, min_gap, max_gap):
+    pattern = sequence[pos:pos + k]
+    chain = [pos]
+    while True:
+        nxt = sequence.find(pattern, chain[-1] + min_gap, chain[-1] + max_gap + k)
+        if nxt < 0:
+            return chain
+        chain.append(nxt)
+
+
+def _column_agrees(sequence, positions):
+    column = [sequence[p] for p in positions]
+    best = max(column.count(base) for base in set(column))
+    return best / len(column) >= EXTEND_THRESHOLD
+
+
+def _extend_repeat(sequence, chain, k, rep_max, spa_min):
+    # grow the seeded k-mer to the full repeat while the repeat columns stay conserved
+    seq_len = len(sequence)
+    right = k
+    while right < rep_max:
+        cols = [p + right for p in chain]
+        if cols[-1] >= seq_len or any(cols[i] >= chain[i + 1] - spa_min for i in range(len(chain) - 1)):
+            break
+        if not _column_agrees(sequence, cols):
+            break
+        right += 1
+    left = 0
+    while right + left < rep_max:
+        cols = [p - left - 1 for p in chain]
+        if cols[0] < 0 or any(cols[i + 1] < chain[i] + right + spa_min for i in range(len(chain) - 1)):
+            break
+        if not _column_agrees(sequence, cols):
+            break
+        left += 1
+    return [p - left for p in chain], left + right
+
+
+def _consensus(repeats):
+    return ''.join(max(set(col), key=col.count) for col in zip(*repeats))
+
+
+def _valid_runs(starts, length, spa_min, spa_max):
+    # split the chain wherever a spacer falls outside [spa_min, spa_max]
+    run = [starts[0]]
+    for prev, cur in zip(starts, starts[1:]):
+        if spa_min <= cur - prev - length <= spa_max:
+            run.append(cur)
+        else:
+            yield run
+            run = [cur]
+    yield run
+
+
+def _has_non_repeating_spacers(sequence, starts, length, unit):
+    spacers = [sequence[a + length:b] for a, b in zip(starts, starts[1:])]
+    if any(_similarity(s, unit) > SPACER_SIMILARITY for s in spacers):
+        return False
+    return all(_similarity(a, b) <= SPACER_SIMILARITY for a, b in zip(spacers, spacers[1:]))
+
+
+def find_arrays(sequence, num_of_repeats, rep_min, rep_max, spa_min, spa_max, k=SEARCH_WINDOW):
+    # returns [(start, end, repeat_number, rpt_unit_seq)], 1-based inclusive like minced
+    k = min(k, rep_min, MAX_K)
+    min_gap, max_gap = rep_min + spa_min, rep_max + spa_max
+    seeds = candidate_seeds(kmer_codes(encode_2bit(sequence), k), min_gap, max_gap)
+    arrays = []
+    resume_at = 0
+    seen = set()
+    for pos in seeds.tolist():
+        if pos < resume_at or pos in seen:
+            continue
+        chain = _repeat_chain(sequence, pos, k, min_gap, max_gap)
+        seen.update(chain)
+        if len(chain) < num_of_repeats:
+            continue
+        starts, length = _extend_repeat(sequence, chain, k, rep_max, spa_min)
+        if length < rep_min:
+            continue
+        for run in _valid_runs(starts, length, spa_min, spa_max):
+            if len(run) < num_of_repeats:
+                continue
+            unit = _consensus([sequence[s:s + length] for s in run])
+            if not _has_non_repeating_spacers(sequence, run, length, unit):
+                continue
+            arrays.append((run[0] + 1, run[-1] + length, len(run), unit))
+            resume_at = run[-1] + length
+    return arrays
+
+
+def gff_lines(records, num_of_repeats, rep_min, rep_max, spa_min, spa_max):
+    # same columns as `minced -gff`: scaffold, source, type, start, end, #repeats, strand, phase, attributes
+    n = 0
+    for name, sequence in records:
+        for start, end, repeat_number, unit in find_arrays(sequence, num_of_repeats, rep_min, rep_max,
+                                                           spa_min, spa_max):
+            n += 1
+            yield (f'{name}\tminced:native\trepeat_region\t{start}\t{end}\t{repeat_number}\t.\t.\t'
+                   f'ID=CRISPR{n};bin={repeat_number};rpt_type=direct;rpt_family=CRISPR;rpt_unit_seq={unit}\n')
@@ -0,0 +1,92 @@
+import os, time, zlib, uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Columnar store for minced array calls (01_array.py --store parquet): one hive-partitioned parquet dataset instead
+# of one repeat_info/*_minced_out.txt per genome. Genomes are hashed into `bucket` partitions and every part file is
+# sorted by fna_path, so 02_ap_pairs_v2.py reads one genome with partition pruning + row-group statistics.
+# Rows are never rewritten: every row carries the start time of the run that wrote it, every scanned genome gets a
+# marker row (no scaffold) in its run, and a genome scanned again (rescan, changed fasta, rerun after a crash) is
+# read from its latest run only, also when that run found no arrays.
+
+N_BUCKETS = 64
+SCHEMA = pa.schema([
+    ('fna_path', pa.string()),
+    ('scaffold', pa.string()),
+    ('start', pa.int64()),
+    ('end', pa.int64()),
+    ('repeat_number', pa.int64()),
+    ('rpt_unit_seq', pa.string()),
+    ('run', pa.int64()),
+    ('bucket', pa.int32()),
+])
+GFF_COLUMNS = ['scaffold', 'source', 'repeat_region', 'start', 'end', 'repeat_number', 'unk_1', 'unk_2', 'attributes']
+
+
+def bucket_of(fna_path):
+    return zlib.crc32(fna_path.encode()) % N_BUCKETS
+
+
+class ArrayStoreWriter:
+    def __init__(self, store_dir, flush_rows=200000):
+        self.store_dir = store_dir
+        self.flush_rows = flush_rows
+        self.rows = []
+        self.run_id = uuid.uuid4().hex[:8]
+        self.run = time.time_ns()
+        self.n_flush = 0
+        os.makedirs(store_dir, exist_ok=True)
+
+    def add_gff(self, fna_path, gff_lines):
+        # gff_lines: minced -gff records of one genome (comment lines are skipped), none for a genome without arrays
+        bucket = bucket_of(fna_path)
+        self.rows.append((fna_path, None, None, None, None, None, self.run, bucket))
+        for line in gff_lines:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            self.rows.append((fna_path, fields[0], int(fields[3]), int(fields[4]), int(fields[5]),
+                              fields[8].split('rpt_unit_seq=')[-1], self.run, bucket))
+
+    def full(self):
+        return len(self.rows) >= self.flush_rows
+
+    def flush(self):
+        if not self.rows:
+            return
+        table = pa.table([list(column) for column in zip(*self.rows)], schema=SCHEMA).sort_by('fna_path')
+        pq.write_to_dataset(table, self.store_dir, partition_cols=['bucket'],
+                            basename_template=f'part-{self.run_id}-{self.n_flush}-{{i}}.parquet',
+                            row_group_size=8192)
+        self.n_flush += 1
+        self.rows = []
+
+
+_DATASETS = {}
+
+
+def read_arrays(store_dir, fna_path=None):
+    # minced GFF-shaped DataFrame (same columns 02_ap_pairs_v2.py reads from a *_minced_out.txt) for one genome,
+    # or for the whole store with fna_path=None (then with an extra fna_path column)
+    if store_dir not in _DATASETS:  # file discovery once per process
+        # explicit schema: parts written before the run column read it as null
+        _DATASETS[store_dir] = ds.dataset(store_dir, schema=SCHEMA, format='parquet', partitioning='hive')
+    dataset = _DATASETS[store_dir]
+    columns = ['fna_path', 'scaffold', 'start', 'end', 'repeat_number', 'rpt_unit_seq', 'run']
+    if fna_path is None:
+        df = dataset.to_table(columns=columns).to_pandas()
+    else:
+        df = dataset.to_table(columns=columns, filter=(ds.field('bucket') == bucket_of(fna_path)) &
+                              (ds.field('fna_path') == fna_path)).to_pandas()
+    # the rows of each genome's latest run only, without the marker rows
+    df['run'] = df['run'].fillna(0)
+    df = df[df['run'] == df.groupby('fna_path')['run'].transform('max')].dropna(subset=['scaffold'])
+    df = df.astype({'start': 'int64', 'end': 'int64', 'repeat_number': 'int64'}).reset_index(drop=True)
+    df['source'] = 'minced'
+    df['repeat_region'] = 'repeat_region'
+    df['unk_1'] = '.'
+    df['unk_2'] = '.'
+    df['attributes'] = 'rpt_unit_seq=' + df['rpt_unit_seq']
+    return df[GFF_COLUMNS if fna_path is not None else ['fna_path'] + GFF_COLUMNS]
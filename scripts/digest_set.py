@@ -0,0 +1,41 @@
+import hashlib
+import numpy as np
+
+# Exact set membership on 128-bit blake2b digests (as the scaffold digests of 01_array.py --dedup) for dedup across
+# chunks: 16 bytes per member in a few sorted numpy blocks instead of the strings themselves.
+
+
+def digests(values):
+    return np.array([hashlib.blake2b(value.encode(), digest_size=16).digest() for value in values], dtype='S16')
+
+
+class DigestSet:
+    def __init__(self):
+        self.blocks = []  # sorted digests, merged while a block is not at least twice the size of the next one
+
+    def __len__(self):
+        return sum(len(block) for block in self.blocks)
+
+    def first_seen(self, values):
+        # mask of the values not seen in earlier calls nor earlier in values (drop_duplicates keep='first' over all
+        # calls); their digests are added to the set
+        return self.first_seen_digests(digests(values))
+
+    def first_seen_digests(self, value_digests):
+        # first_seen() on digests already computed (an 'S16' array)
+        keep = np.zeros(len(value_digests), dtype=bool)
+        keep[np.unique(value_digests, return_index=True)[1]] = True
+        for block in self.blocks:
+            candidates = np.flatnonzero(keep)
+            index = np.minimum(np.searchsorted(block, value_digests[candidates]), len(block) - 1)
+            keep[candidates[block[index] == value_digests[candidates]]] = False
+        self.add(value_digests[keep])
+        return keep
+
+    def add(self, value_digests):
+        if not len(value_digests):
+            return
+        self.blocks.append(np.sort(value_digests))
+        while len(self.blocks) > 1 and len(self.blocks[-2]) < 2 * len(self.blocks[-1]):
+            block = self.blocks.pop()
+            self.blocks[-1] = np.sort(np.concatenate([self.blocks[-1], block]))
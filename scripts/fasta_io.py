@@ -0,0 +1,294 @@
+import bisect, gzip, hashlib, io, mmap, os, struct, threading, zlib
+
+# Compression-transparent access to genome fasta files (.fna, .fna.gz, bgzip, .fna.zst), shared by 01 and 02.
+# The format is taken from the magic bytes, not the file extension.
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compression(path):
+    # None, 'gzip', 'bgzip' (blocked gzip, random access possible) or 'zstd'
+    with open(path, 'rb') as handle:
+        head = handle.read(18)
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if head.startswith(GZIP_MAGIC):
+        # BGZF = gzip member with the FEXTRA flag and a 'BC' extra subfield
+        if len(head) >= 14 and head[3] & 4 and head[12:14] == b'BC':
+            return 'bgzip'
+        return 'gzip'
+    return None
+
+
+def _bgzf_blocks(path):
+    # (compressed, uncompressed) start offsets of every BGZF block, then those of the end of the file, from the block
+    # headers only
+    compressed, uncompressed = 0, 0
+    with open(path, 'rb') as handle:
+        while True:
+            yield compressed, uncompressed
+            header = handle.read(18)
+            if len(header) < 18:
+                break
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            handle.seek(compressed + block_size - 4)
+            uncompressed += struct.unpack('<I', handle.read(4))[0]
+            compressed += block_size
+            handle.seek(compressed)
+
+
+def _zstd_content_size(path):
+    # sum of the frame content sizes of a zstd file, walking the frame and block headers; None if a frame does not
+    # record its size (streamed compression)
+    total = 0
+    with open(path, 'rb') as handle:
+        while True:
+            magic = handle.read(4)
+            if not magic:
+                return total
+            if len(magic) == 4 and magic[1:] == b'\x2a\x4d\x18' and magic[0] & 0xf0 == 0x50:  # skippable frame
+                handle.seek(struct.unpack('<I', handle.read(4))[0], 1)
+                continue
+            if magic != ZSTD_MAGIC:
+                return None
+            descriptor = handle.read(1)[0]
+            single_segment = descriptor >> 5 & 1
+            content_size_bytes = (single_segment, 2, 4, 8)[descriptor >> 6]
+            if not content_size_bytes:
+                return None
+            handle.seek((1 - single_segment) + (0, 1, 2, 4)[descriptor & 3], 1)  # window descriptor, dictionary ID
+            total += int.from_bytes(handle.read(content_size_bytes), 'little') + (256 if content_size_bytes == 2 else 0)
+            while True:
+                header = handle.read(3)
+                if len(header) < 3:
+                    return None
+                block = int.from_bytes(header, 'little')
+                handle.seek(1 if block >> 1 & 3 == 1 else block >> 3, 1)  # an RLE block stores a single byte
+                if block & 1:
+                    break
+            if descriptor >> 2 & 1:
+                handle.seek(4, 1)  # content checksum
+
+
+def uncompressed_size(path):
+    # size of the decompressed fasta from the container, without decompressing: gzip ISIZE trailer, bgzip block
+    # trailers, zstd frame headers. Falls back to the file size where the container does not tell (a zstd stream
+    # without content size, a gzip ISIZE below the file size: only the last member's, or wrapped past 4 GB)
+    size = os.path.getsize(path)
+    try:
+        kind = compression(path)
+        if kind == 'bgzip':
+            *_, (_, content_size) = _bgzf_blocks(path)
+        elif kind == 'gzip':
+            with open(path, 'rb') as handle:
+                handle.seek(-4, os.SEEK_END)
+                content_size = struct.unpack('<I', handle.read(4))[0]
+            content_size = content_size if content_size >= size else None
+        elif kind == 'zstd':
+            content_size = _zstd_content_size(path)
+        else:
+            return size
+    except (OSError, struct.error, IndexError):
+        return size
+    return size if content_size is None else content_size
+
+
+def open_binary(path):
+    kind = compression(path)
+    if kind in ('gzip', 'bgzip'):
+        return gzip.open(path, 'rb')
+    if kind == 'zstd':
+        import zstandard  # optional, only needed for .zst genomes
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def open_fasta(path):
+    # text handle over the (decompressed) fasta, same encoding the pipeline always used
+    return io.TextIOWrapper(open_binary(path), encoding='ISO-8859-1')
+
+
+def feed_fifo(path, fifo_path):
+    # decompress into a named pipe so tools that only take a file path (minced) can stream a compressed genome; the
+    # fasta records are counted on the copied blocks (writer.records, complete once the writer is done)
+    os.mkfifo(fifo_path)
+
+    def feed():
+        last = b'\n'
+        try:
+            with open_binary(path) as source, open(fifo_path, 'wb') as sink:
+                for block in iter(lambda: source.read(1 << 20), b''):
+                    writer.records += block.count(b'\n>') + (last == b'\n' and block[:1] == b'>')
+                    last = block[-1:]
+                    sink.write(block)
+        except OSError:  # reader went away (tool failed or was killed)
+            pass
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.records = 0
+    writer.start()
+    return writer
+
+
+def release_fifo(fifo_path, writer):
+    # a writer still blocked in open() (the tool never opened the pipe) is released by a dummy reader
+    if writer.is_alive():
+        try:
+            os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+        writer.join(timeout=10)
+    if os.path.exists(fifo_path):
+        os.remove(fifo_path)
+
+
+def _index_path(path, suffix, index_dir):
+    # samtools-style index next to the genome if there is a fresh one, otherwise our own copy in index_dir
+    beside = f'{path}{suffix}'
+    if index_dir is None or (os.path.exists(beside) and os.path.getmtime(beside) >= os.path.getmtime(path)):
+        return beside
+    path_hash = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]
+    return f'{index_dir}/{os.path.basename(path)}.{path_hash}{suffix}'
+
+
+def _is_fresh(index_path, path):
+    return os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path)
+
+
+def _write_atomic(index_path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(data)
+    os.replace(tmp, index_path)  # concurrent builders of the same index cannot leave a half-written file
+
+
+def build_fai(path):
+    # one pass over the (decompressed) fasta -> faidx lines: name, length, offset, linebases, linewidth.
+    # records whose lines are not all of one width (or carry spaces) get linebases = linewidth = 0 and are read whole
+    entries, offset, record = [], 0, None
+    with open_binary(path) as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                title = line[1:].split(None, 1)
+                record = [title[0].decode('ISO-8859-1') if title else '', 0, offset + len(line), 0, 0, False, True]
+                entries.append(record)  # [.., saw a short line, regular]
+            elif record is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases and (record[5] or b' ' in line or b'\t' in line or
+                              (record[3] and (bases > record[3] or len(line) - bases != record[4] - record[3]))):
+                    record[6] = False
+                if bases and not record[3]:
+                    record[3], record[4] = bases, len(line)
+                elif bases < record[3]:
+                    record[5] = True
+                record[1] += bases
+            offset += len(line)
+    return ''.join(f'{name}\t{length}\t{start}\t{linebases if regular else 0}\t{linewidth if regular else 0}\n'
+                   for name, length, start, linebases, linewidth, _, regular in entries)
+
+
+def build_gzi(path):
+    # BGZF block offsets (compressed, uncompressed) in the samtools .gzi layout: every block but the first
+    blocks = list(_bgzf_blocks(path))[1:-1]
+    return struct.pack('<Q', len(blocks)) + b''.join(struct.pack('<QQ', *block) for block in blocks)
+
+
+def count_records(path):
+    # records of a plain fasta without parsing it: the lines of a fresh .fai beside it, otherwise the '>' at line
+    # starts counted over an mmap (the pages stay cached for the tool that reads the file next)
+    fai_path = f'{path}.fai'
+    if _is_fresh(fai_path, path):
+        with open(fai_path, 'rb') as fai:
+            return sum(1 for _ in fai)
+    if not os.path.getsize(path):
+        return 0
+    with open(path, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        n, position = int(data[:1] == b'>'), data.find(b'\n>')
+        while position != -1:
+            n += 1
+            position = data.find(b'\n>', position + 2)
+        return n
+
+
+class IndexedFasta:
+    # faidx-style random access to a plain or bgzip fasta through mmap: only the pages (bgzip: the 64 KB blocks) of
+    # the requested ranges are read. Indexes are built once and reused while newer than the fasta
+    def __init__(self, path, index_dir=None):
+        self.path = path
+        self.kind = compression(path)
+        if self.kind not in (None, 'bgzip'):
+            raise ValueError(f'{path}: {self.kind} compressed fasta has no random access, use bgzip')
+        fai_path = _index_path(path, '.fai', index_dir)
+        if not _is_fresh(fai_path, path):
+            _write_atomic(fai_path, build_fai(path).encode('ISO-8859-1'))
+        self.index = {}
+        with open(fai_path, encoding='ISO-8859-1') as fai:
+            for line in fai:
+                name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')[:5]
+                self.index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+        self.offsets = sorted(offset for _, offset, _, _ in self.index.values())
+        self.handle = open(path, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b''
+        if self.kind == 'bgzip':
+            gzi_path = _index_path(path, '.gzi', index_dir)
+            if not _is_fresh(gzi_path, path):
+                _write_atomic(gzi_path, build_gzi(path))
+            with open(gzi_path, 'rb') as gzi:
+                raw = gzi.read()
+            n_blocks = struct.unpack('<Q', raw[:8])[0]
+            blocks = [(0, 0)] + [struct.unpack('<QQ', raw[8 + 16 * i: 24 + 16 * i]) for i in range(n_blocks)]
+            self.block_offsets = [compressed for compressed, _ in blocks]
+            self.block_starts = [uncompressed for _, uncompressed in blocks]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.handle.close()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def length(self, name):
+        return self.index[name][0]
+
+    def _read(self, start, end):
+        # bytes [start, end) of the uncompressed file, end=None: to the end of the file
+        if self.kind is None:
+            return self.data[start:end]
+        first_block = bisect.bisect_right(self.block_starts, start) - 1
+        chunks, covered = [], self.block_starts[first_block]
+        for offset in self.block_offsets[first_block:]:  # the .gzi lists every block
+            if end is not None and covered >= end:
+                break
+            block_size = struct.unpack('<H', self.data[offset + 16: offset + 18])[0] + 1
+            chunks.append(zlib.decompress(self.data[offset + 18: offset + block_size - 8], -15))
+            covered += len(chunks[-1])
+        skip = start - self.block_starts[first_block]
+        return b''.join(chunks)[skip: None if end is None else skip + end - start]
+
+    def fetch(self, name, start, end):
+        # sequence[start:end] of a record (0-based, end exclusive), as stored (case kept)
+        return self.fetch_bytes(name, start, end).decode('ISO-8859-1')
+
+    def fetch_bytes(self, name, start, end):
+        # fetch() as the ASCII bytes, without a str copy
+        length, offset, linebases, linewidth = self.index[name]
+        start, end = max(0, start), min(end, length)
+        if end <= start:
+            return b''
+        if not linebases:  # irregular line layout: the record up to the next header
+            following = bisect.bisect_right(self.offsets, offset)
+            raw = self._read(offset, self.offsets[following] if following < len(self.offsets) else None)
+            raw = raw.split(b'>', 1)[0].translate(None, b'\r\n \t')
+            return raw[start:end]
+        first = offset + start // linebases * linewidth + start % linebases
+        last = offset + (end - 1) // linebases * linewidth + (end - 1) % linebases + 1
+        return self._read(first, last).translate(None, b'\r\n')
@@ -0,0 +1,66 @@
+import collections, os, subprocess
+from Bio import SeqIO
+
+# Gene-calling backends for 02_ap_pairs_v2.py --gene-caller. Every backend takes an iterable of (record name, masked
+# window as ASCII bytes, possibly a view of a reused buffer: valid until the next record is taken) and the genome's
+# faa path and returns {record name: [(protein, start, end)]}: prodigal -p meta -m calls in prodigal's order, 1-based
+# coordinates in the window, proteins with the stop '*' as in prodigal's .faa
+
+
+def parse_faa(faa_file_path):
+    # proteins are demultiplexed on the record name prodigal puts before '_<gene number>'
+    cds_by_window = collections.defaultdict(list)
+    for cds in SeqIO.parse(faa_file_path, 'fasta'):
+        fields = cds.description.split(' # ')
+        cds_by_window[cds.id.rsplit('_', 1)[0]].append((str(cds.seq), int(fields[1]), int(fields[2])))
+    return cds_by_window
+
+
+def run_prodigal(records, faa_file_path):
+    # records are written to prodigal's stdin as they come, no joined fasta (the gff on stdout is not used)
+    command = ['prodigal', '-a', faa_file_path, '-q', '-p', 'meta', '-f', 'gff', '-m']
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    with process.stdin:
+        for name, masked in records:
+            process.stdin.write(f'>{name}\n'.encode())
+            process.stdin.write(masked)
+            process.stdin.write(b'\n')
+    process.wait()
+    return parse_faa(faa_file_path)
+
+
+def call_per_window(windows, faa_file_path):
+    # one prodigal process and one prodigal_faa/<faa_file_name>.faa per window (the original behaviour)
+    cds_by_window = {}
+    for name, masked in windows:
+        cds_by_window.update(run_prodigal([(name, masked)], f'{os.path.dirname(faa_file_path)}/{name}.faa'))
+    return cds_by_window
+
+
+def call_batched(windows, faa_file_path):
+    # one prodigal process per genome, all windows as records of one fasta on stdin (meta mode predicts each record
+    # on its own, so the calls are those of call_per_window)
+    return run_prodigal(windows, faa_file_path)
+
+
+_GENE_FINDER = None
+
+
+def call_pyrodigal(windows, faa_file_path=None):
+    # in-process Prodigal (pyrodigal, same algorithm and models): no fork, no .faa file
+    global _GENE_FINDER
+    if _GENE_FINDER is None:
+        import pyrodigal  # optional, only needed for --gene-caller pyrodigal
+        _GENE_FINDER = pyrodigal.GeneFinder(meta=True, mask=True)
+    cds_by_window = {}
+    for name, masked in windows:
+        genes = _GENE_FINDER.find_genes(masked)
+        cds_by_window[name] = [(gene.translate(), gene.begin, gene.end) for gene in genes]
+    return cds_by_window
+
+
+GENE_CALLERS = {
+    'prodigal': call_per_window,
+    'batched': call_batched,
+    'pyrodigal': call_pyrodigal,
+}
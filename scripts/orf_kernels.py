@@ -0,0 +1,106 @@
+import numpy as np
+
+# NumPy kernels for the CDS <-> array geometry of 02_ap_pairs_v2.py and 03_pairs_to_fasta.py. They work on the CDS of
+# many arrays at once: CDS of array i are the next counts[i] entries of the flat start/end arrays, in gene-caller
+# order, in 1-based inclusive window coordinates; arrays are 0-based [start, end) spans in the same window.
+
+
+def group_index(counts):
+    # array index and position within its array of every flat CDS entry
+    counts = np.asarray(counts, dtype=np.int64)
+    group = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return group, position
+
+
+def cds_positions(cds_starts, cds_ends, counts, array_starts, array_ends):
+    # -> cds2rep_dist (smallest distance between a CDS end and an array end) and num_th_orf (1, 2, 3... counted away
+    # from the array on each side) per CDS
+    cds_starts, cds_ends = np.asarray(cds_starts, dtype=np.int64), np.asarray(cds_ends, dtype=np.int64)
+    group, position = group_index(counts)
+    array_starts = np.asarray(array_starts, dtype=np.int64)[group]
+    array_ends = np.asarray(array_ends, dtype=np.int64)[group]
+    dist = np.minimum.reduce([np.abs(array_starts - cds_starts), np.abs(array_starts - cds_ends),
+                              np.abs(array_ends - cds_starts), np.abs(array_ends - cds_ends)])
+    # CDS starting at or before the array start sort before it (ties keep the CDS first, as the list sort did)
+    n_before = np.bincount(group, weights=cds_starts <= array_starts, minlength=len(counts)).astype(np.int64)[group]
+    num_th_orf = np.where(position < n_before, n_before - position, position - n_before + 1)
+    return dist, num_th_orf
+
+
+def shift_to_window(cds_starts, cds_ends, counts, shifts, lengths):
+    # CDS moved by each array's shift into a window of its length -> (kept, clipped starts, clipped ends, truncated);
+    # CDS outside the window are not kept, those reaching over an edge are clipped to it and flagged as truncated
+    group, _ = group_index(counts)
+    starts = np.asarray(cds_starts, dtype=np.int64) + np.asarray(shifts, dtype=np.int64)[group]
+    ends = np.asarray(cds_ends, dtype=np.int64) + np.asarray(shifts, dtype=np.int64)[group]
+    lengths = np.asarray(lengths, dtype=np.int64)[group]
+    kept = (ends >= 1) & (starts <= lengths)
+    truncated = (starts < 1) | (ends > lengths)
+    return kept, np.maximum(starts, 1), np.minimum(ends, lengths), truncated
+
+
+def threshold_levels(values, thresholds):
+    # index of the smallest of the sorted thresholds a value is within: the value passes thresholds[level:] (none for
+    # level == len(thresholds)), so one pass routes every CDS to all the nested 03 --bp/--orf sets it belongs to
+    return np.searchsorted(np.asarray(thresholds, dtype=np.int64), np.asarray(values, dtype=np.int64), side='left')
+
+
+if __name__ == '__main__':
+    # micro-benchmarks against the per-array list code these kernels replace (python orf_kernels.py [n_arrays])
+    import itertools, sys, timeit
+
+    def positions_lists(cds_start_end, new_positions):
+        cds2rep_dist_abs = [min([abs(a - int(b)) for a, b in itertools.product(new_positions, cds)])
+                            for cds in cds_start_end]
+        cds_start_end = [[int(x), int(y)] for x, y in cds_start_end]
+        cds_start_end.append(new_positions)
+        cds_start_end.sort(key=lambda x: x[0])
+        index_of_new_positions = cds_start_end.index(new_positions)
+        elements_before = [i for i in range(index_of_new_positions, 0, -1)]
+        elements_after = len(cds_start_end) - index_of_new_positions - 1
+        elements_before.extend([i for i in range(elements_after + 1) if i > 0])
+        return cds2rep_dist_abs, elements_before
+
+    def shift_lists(cds_start_end, shift, length):
+        cds = [(start + shift, end + shift) for start, end in cds_start_end]
+        cds = [(start, end) for start, end in cds if end >= 1 and start <= length]
+        return [(max(start, 1), min(end, length)) for start, end in cds], [start < 1 or end > length
+                                                                            for start, end in cds]
+
+    n_arrays = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rng = np.random.default_rng(0)
+    counts = rng.integers(1, 25, n_arrays)
+    array_starts = rng.integers(0, 10000, n_arrays)
+    array_ends = array_starts + rng.integers(100, 3000, n_arrays)
+    arrays = []
+    for count, array_start, array_end in zip(counts, array_starts, array_ends):
+        starts = np.sort(rng.integers(1, array_end + 10000, count))
+        arrays.append(([[int(s), int(s + e)] for s, e in zip(starts, rng.integers(90, 3000, count))],
+                       [int(array_start), int(array_end)]))
+    cds_starts = np.array([s for cds, _ in arrays for s, _ in cds])
+    cds_ends = np.array([e for cds, _ in arrays for _, e in cds])
+
+    dist, num_th_orf = cds_positions(cds_starts, cds_ends, counts, array_starts, array_ends)
+    reference = [positions_lists(cds, span) for cds, span in arrays]
+    assert dist.tolist() == [value for values, _ in reference for value in values]
+    assert num_th_orf.tolist() == [value for _, values in reference for value in values]
+    shifts, lengths = -array_starts, array_ends - array_starts
+    kept, starts, ends, truncated = shift_to_window(cds_starts, cds_ends, counts, shifts, lengths)
+    reference = [shift_lists(cds, shift, length) for (cds, _), shift, length in zip(arrays, shifts, lengths)]
+    assert list(zip(starts[kept].tolist(), ends[kept].tolist())) == [cds for shifted, _ in reference for cds in shifted]
+    assert truncated[kept].tolist() == [flag for _, flags in reference for flag in flags]
+
+    n_repeat = 5
+    seconds_lists = timeit.timeit(lambda: [positions_lists(cds, span) for cds, span in arrays], number=n_repeat)
+    seconds_kernel = timeit.timeit(lambda: cds_positions(cds_starts, cds_ends, counts, array_starts, array_ends),
+                                   number=n_repeat)
+    seconds_shift_lists = timeit.timeit(lambda: [shift_lists(cds, shift, length) for (cds, _), shift, length in
+                                                 zip(arrays, shifts, lengths)], number=n_repeat)
+    seconds_shift = timeit.timeit(lambda: shift_to_window(cds_starts, cds_ends, counts, shifts, lengths),
+                                  number=n_repeat)
+    print(f'{n_arrays} arrays, {len(cds_starts)} CDS')
+    print(f'cds_positions:   lists {seconds_lists / n_repeat * 1e3:.2f} ms, kernel '
+          f'{seconds_kernel / n_repeat * 1e3:.2f} ms ({seconds_lists / seconds_kernel:.1f}x)')
+    print(f'shift_to_window: lists {seconds_shift_lists / n_repeat * 1e3:.2f} ms, kernel '
+          f'{seconds_shift / n_repeat * 1e3:.2f} ms ({seconds_shift_lists / seconds_shift:.1f}x)')
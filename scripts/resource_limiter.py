@@ -0,0 +1,131 @@
+import contextlib, os, resource, signal, subprocess, threading, time
+
+# Admission control for the worker pools of 01_array.py and 02_ap_pairs_v2.py: every task gets a memory
+# estimate from its input file size and is only submitted while the estimates in flight fit the RAM budget.
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(text):
+    # '64G', '512M', '1.5T' or plain bytes -> bytes
+    text = str(text).strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in _UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * _UNITS[unit])
+
+
+def format_size(n_bytes):
+    for unit in ('B', 'K', 'M', 'G'):
+        if n_bytes < 1024:
+            return f'{n_bytes:.1f}{unit}'
+        n_bytes /= 1024
+    return f'{n_bytes:.1f}T'
+
+
+def peak_child_rss():
+    # largest resident set of any finished (and waited for) child process, in bytes; ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+_CHILD_GROUPS = set()  # process groups of the running run_with_usage() children
+_CHILD_GROUPS_LOCK = threading.Lock()
+_STOPPING = threading.Event()
+
+
+def kill_child_groups():
+    # the children run in their own session, out of reach of the terminal's Ctrl-C: kill their whole groups and
+    # start no new ones
+    with _CHILD_GROUPS_LOCK:
+        _STOPPING.set()
+        groups = list(_CHILD_GROUPS)
+    for group in groups:
+        try:
+            os.killpg(group, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+@contextlib.contextmanager
+def kill_children_on_exit():
+    # KeyboardInterrupt or SIGTERM in the block: kill the child groups, then re-raise (SIGTERM: the signal is sent
+    # again to the default handler). Enter it inside the worker pool, so the pool's shutdown does not wait on them
+    def on_sigterm(signum, frame):
+        kill_child_groups()
+        signal.signal(signal.SIGTERM, previous if previous is not None else signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    previous = signal.signal(signal.SIGTERM, on_sigterm)
+    try:
+        yield
+    except KeyboardInterrupt:
+        kill_child_groups()
+        raise
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def run_with_usage(command, timeout=None):
+    # subprocess.run() that also returns the child's own rusage (CPU time, peak RSS) via wait4; after timeout seconds
+    # the child's whole process group is killed (minced is a shell wrapper around java, the JVM must not survive it)
+    # and subprocess.TimeoutExpired (carrying the killed child's rusage as .usage) raised
+    with _CHILD_GROUPS_LOCK:
+        if _STOPPING.is_set():
+            raise RuntimeError(f'not started, shutting down: {command[0]}')
+        process = subprocess.Popen(command, start_new_session=True)
+        _CHILD_GROUPS.add(process.pid)
+    try:
+        return _wait_with_usage(process, command, timeout)
+    finally:
+        with _CHILD_GROUPS_LOCK:
+            _CHILD_GROUPS.discard(process.pid)
+
+
+def _wait_with_usage(process, command, timeout):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            _, _, usage = os.wait4(process.pid, 0)
+            process.returncode = -9  # reaped here, keep Popen from waiting on it again
+            error = subprocess.TimeoutExpired(command, timeout)
+            error.usage = usage
+            raise error
+        time.sleep(0.05)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+
+class MemoryBudget:
+    def __init__(self, budget_bytes=None, base_bytes=200 << 20, bytes_per_input_byte=3.0):
+        self.budget_bytes = budget_bytes  # None = unlimited, tasks are only bounded by the pool width
+        self.base_bytes = base_bytes
+        self.bytes_per_input_byte = bytes_per_input_byte
+        self.in_use = 0
+        self.peak_in_use = 0
+        self._lock = threading.Lock()
+
+    def estimate(self, input_bytes):
+        return int(self.base_bytes + self.bytes_per_input_byte * input_bytes)
+
+    def try_admit(self, cost):
+        # a task bigger than the whole budget is still admitted once nothing else is running
+        with self._lock:
+            if self.budget_bytes is not None and self.in_use > 0 and self.in_use + cost > self.budget_bytes:
+                return False
+            self.in_use += cost
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            return True
+
+    def release(self, cost):
+        with self._lock:
+            self.in_use -= cost
+
+    def report(self):
+        budget = 'unlimited' if self.budget_bytes is None else format_size(self.budget_bytes)
+        return (f'memory budget {budget}, peak estimated in flight {format_size(self.peak_in_use)}, '
+                f'peak RSS of a single worker/child {format_size(peak_child_rss())}')